@@ -0,0 +1,185 @@
+import os
+import sqlite3
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import get_data as gd
+import main
+from cache import QueryCache
+from sparql_client import SPARQLClient
+
+#The detectors run on every property, with their arguments
+DEFAULT_METHODS = {
+    'IQR' : ('find_outliers_using_IQR', {'upper' : 95, 'lower' : 5}),
+    'MAD' : ('find_outliers_using_MAD', {}),
+    'KDE' : ('KDE', {'method' : 'binned'}),
+}
+
+#A detector is expected to need about this many times the size of the values
+#(sorting, absolute deviations, masks), plus a fixed amount for the KDE blocks
+DETECTOR_MEMORY_FACTOR = 6
+DETECTOR_MEMORY_FIXED = 64*1024**2
+
+
+class ResultStore(object):
+    """The consolidated results of a batch run, in a single SQLite file.
+
+        The tables are
+        properties : One row per (class, property) with the number of values, \
+                    the number of values which could not be parsed and the \
+                    time at which the values were fetched
+        detections : One row per (class, property, method) with the number \
+                    of outliers and the time the detector took
+        outliers : One row per outlier with its class, property, method, \
+                    entity URI and value
+        parsing_errors : The values which could not be parsed
+
+    Storing a property again replaces its previous results.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS properties (class TEXT, property TEXT,
+                rows INTEGER, parsing_errors INTEGER, fetched REAL,
+                PRIMARY KEY (class, property));
+            CREATE TABLE IF NOT EXISTS detections (class TEXT, property TEXT,
+                method TEXT, outliers INTEGER, seconds REAL,
+                PRIMARY KEY (class, property, method));
+            CREATE TABLE IF NOT EXISTS outliers (class TEXT, property TEXT,
+                method TEXT, entity TEXT, value REAL);
+            CREATE INDEX IF NOT EXISTS outliers_property ON outliers (class, property, method);
+            CREATE TABLE IF NOT EXISTS parsing_errors (class TEXT, property TEXT,
+                entity TEXT, value TEXT);
+        """)
+
+    def add_property(self, spec, rows, parsing_error):
+        class_name, property_name = spec
+        for table in ('detections', 'outliers', 'parsing_errors'):
+            self._connection.execute("DELETE FROM %s WHERE class = ? AND property = ?" % table, spec)
+        self._connection.execute("INSERT OR REPLACE INTO properties VALUES (?, ?, ?, ?, ?)", \
+                        (class_name, property_name, rows, len(parsing_error), time.time()))
+        self._connection.executemany("INSERT INTO parsing_errors VALUES (?, ?, ?, ?)", \
+                ((class_name, property_name, each, parsing_error[each]) for each in parsing_error))
+        self._connection.commit()
+
+    def add_outliers(self, spec, method, uris, values, indices, seconds):
+        class_name, property_name = spec
+        self._connection.execute("INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?, ?)", \
+                        (class_name, property_name, method, len(indices), seconds))
+        self._connection.executemany("INSERT INTO outliers VALUES (?, ?, ?, ?, ?)", \
+                ((class_name, property_name, method, uris[i], float(values[i])) for i in indices))
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+
+def _fetch(spec, options):
+    parsing_error = {}
+    values, uris = gd.get_property_values(spec[0], spec[1], parsing_error = parsing_error, **options)
+    return values, uris, parsing_error
+
+def _detect(function_name, values, arguments):
+    start = time.time()
+    indices = getattr(main, function_name)(values, **arguments)
+    return np.asarray(indices), time.time() - start
+
+def _detector_memory(values):
+    return DETECTOR_MEMORY_FACTOR*values.nbytes + DETECTOR_MEMORY_FIXED
+
+def run_batch(specs, store_path, methods = DEFAULT_METHODS, max_workers = None, \
+                memory_budget = 4*1024**3, fetch_workers = 2, **fetch_options):
+    """This function finds the outliers of many properties in one run.
+
+        The arguments are
+        specs : A list of (class, property) pairs, e.g. \
+                            ('dbo:Company', 'dbo:numberOfEmployees')
+        store_path : The SQLite file of the ResultStore
+        methods : A dictionary of method name : (name of the detector in \
+                    main.py, its arguments), by default DEFAULT_METHODS
+        max_workers : The number of detector processes (by default one per CPU)
+        memory_budget : The number of bytes the fetched values and the \
+                    running detectors may use together
+        fetch_workers : The number of properties fetched at the same time
+        fetch_options : Passed on to get_data.iter_property_pages
+
+        Every property is fetched once, by up to fetch_workers threads.
+        Every method runs on every property as a separate task in a process
+        pool, and a task only starts while the estimated memory of the
+        fetched values and the running tasks stays within memory_budget.
+        There is always at least one task running, even if it alone is over
+        the budget. The results of all the properties are written to one
+        ResultStore.
+    """
+    specs = list(dict.fromkeys(tuple(each) for each in specs))
+    store = ResultStore(store_path)
+    pending = deque(specs)
+    ready = deque()
+    fetching = {}
+    running = {}
+    datasets = {}
+    in_use = 0
+    with ThreadPoolExecutor(max_workers = fetch_workers) as fetcher, \
+                        ProcessPoolExecutor(max_workers = max_workers) as pool:
+        while pending or fetching or ready or running:
+            while pending and len(fetching) < fetch_workers and \
+                                        (in_use < memory_budget or not datasets):
+                spec = pending.popleft()
+                fetching[fetcher.submit(_fetch, spec, fetch_options)] = spec
+            while ready:
+                spec, method = ready[0]
+                cost = _detector_memory(datasets[spec][0])
+                if running and in_use + cost > memory_budget:
+                    break
+                ready.popleft()
+                function_name, arguments = methods[method]
+                future = pool.submit(_detect, function_name, datasets[spec][0], arguments)
+                running[future] = (spec, method, cost)
+                in_use += cost
+
+            done, _ = wait(list(fetching) + list(running), return_when = FIRST_COMPLETED)
+            for future in done:
+                if future in fetching:
+                    spec = fetching.pop(future)
+                    try:
+                        values, uris, parsing_error = future.result()
+                    except Exception as e:
+                        print("Fetching %s %s failed" % spec)
+                        print(e)
+                        continue
+                    print("Fetched %d values of %s %s" % (values.size, spec[0], spec[1]))
+                    store.add_property(spec, values.size, parsing_error)
+                    if values.size == 0 or not methods:
+                        continue
+                    size = values.nbytes + uris.nbytes
+                    datasets[spec] = [values, uris, len(methods), size]
+                    in_use += size
+                    ready.extend((spec, method) for method in methods)
+                else:
+                    spec, method, cost = running.pop(future)
+                    in_use -= cost
+                    values, uris = datasets[spec][:2]
+                    try:
+                        indices, seconds = future.result()
+                        store.add_outliers(spec, method, uris, values, indices, seconds)
+                    except Exception as e:
+                        print("%s failed on %s %s" % (method, spec[0], spec[1]))
+                        print(e)
+                    datasets[spec][2] -= 1
+                    if datasets[spec][2] == 0:
+                        in_use -= datasets.pop(spec)[3]
+    store.close()
+
+
+if __name__=="__main__":
+    #python3 batch.py specs.txt results.sqlite
+    #with one "class property" pair per line of specs.txt
+    gd.set_client(SPARQLClient(cache = QueryCache(os.getcwd() + "/data/sparql_cache.sqlite", \
+                        offline = os.environ.get("SPARQL_OFFLINE") == "1")))
+    with open(sys.argv[1]) as f:
+        specs = [line.split() for line in f if line.strip() and not line.startswith('#')]
+    run_batch(specs, sys.argv[2] if len(sys.argv) > 2 else os.getcwd() + "/data/results.sqlite")
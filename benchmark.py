@@ -0,0 +1,229 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+from scipy import sparse
+import clustering as cl
+import main
+
+DEFAULT_SIZES = [10**3, 10**4, 10**5, 10**6, 10**7]
+
+
+def make_values(n, distribution = 'lognormal', error_rate = 0.01, random_state = 0):
+    """This function generates values shaped like a numeric DBPedia property.
+
+        The arguments are
+        n : The number of values
+        distribution : 'lognormal' (e.g. populations) or 'pareto' (e.g. \
+                    numbers of employees, with a heavier tail)
+        error_rate : The fraction of values with a unit scale error, they \
+                    are multiplied by 1000 or 1e6 or divided by 1000 (as if \
+                    given in thousands, millions or the wrong unit)
+        random_state : The seed
+
+        It returns the numpy array of the (integer valued) values and the
+        sorted indices of the values with an injected error.
+    """
+    rng = np.random.RandomState(random_state)
+    if distribution == 'lognormal':
+        values = rng.lognormal(mean = 9, sigma = 2, size = n)
+    elif distribution == 'pareto':
+        values = (rng.pareto(1.2, size = n) + 1)*100
+    else:
+        raise ValueError("Unknown distribution %r" % distribution)
+    errors = np.sort(rng.choice(n, int(error_rate*n), replace = False))
+    values[errors] *= rng.choice([1e3, 1e6, 1e-3], size = errors.size)
+    return np.round(values), errors
+
+def make_types(n, n_clusters = 8, n_types = 200, core_types = 6, noise_types = 2, \
+                                                        random_state = 0):
+    """This function generates clustered type vectors like the ones of
+    clustering.prepare_dataset.
+
+        Every cluster has core_types types (e.g. dbo:Company, dbo:Agent, ...)
+        which each of its entities has with probability 0.9, and every entity
+        gets noise_types more random types out of n_types.
+
+        It returns the cluster of every entity and the CSR matrix of uint8
+        with one row per entity.
+    """
+    rng = np.random.RandomState(random_state)
+    labels = rng.randint(n_clusters, size = n)
+    profiles = np.array([rng.choice(n_types, core_types, replace = False) \
+                                                    for _ in range(n_clusters)])
+    core = profiles[labels]
+    present = rng.rand(n, core_types) < 0.9
+    noise = rng.randint(n_types, size = (n, noise_types))
+    columns = np.concatenate((np.where(present, core, -1), noise), axis = 1)
+    rows = np.repeat(np.arange(n), columns.shape[1])
+    columns = columns.ravel()
+    kept = columns >= 0
+    X = sparse.csr_matrix((np.ones(kept.sum(), dtype = np.uint8), (rows[kept], columns[kept])), \
+                                                        shape = (n, n_types))
+    X.sum_duplicates()
+    X.data[:] = 1
+    return labels, X
+
+def entity_types_of(uris, X):
+    """Returns the (entity_type, all_types) pair of clustering.get_all_types for
+    the type matrix X, so prepare_dataset can run without DBPedia."""
+    names = ["http://dbpedia.org/ontology/Type%d" % i for i in range(X.shape[1])]
+    entity_type = {}
+    for uri, start, stop in zip(uris, X.indptr[:-1], X.indptr[1:]):
+        entity_type[uri] = [names[i] for i in X.indices[start:stop]]
+    counts = np.bincount(X.indices, minlength = X.shape[1])
+    return entity_type, dict((names[i], int(counts[i])) for i in np.flatnonzero(counts))
+
+
+def _outliers(indices, dataset):
+    indices = np.asarray(indices)
+    return {'outliers' : int(indices.size), \
+            'recall' : float(np.intersect1d(indices, dataset['errors']).size)/max(dataset['errors'].size, 1)}
+
+#name : (the function of a dataset, the largest number of rows it is run on)
+BENCHMARKS = {
+    'IQR' : (lambda d: _outliers(main.find_outliers_using_IQR(d['values'], 95, 5), d), 10**7),
+    'IQR_clusters' : (lambda d: _outliers(main.find_outliers_using_IQR(d['values'], 95, 5, \
+                            preprocess = True, clusters = d['clusters']), d), 10**7),
+    'MAD' : (lambda d: _outliers(main.find_outliers_using_MAD(d['values']), d), 10**7),
+    'MAD_clusters' : (lambda d: _outliers(main.find_outliers_using_MAD(d['values'], \
+                            preprocess = True, clusters = d['clusters']), d), 10**7),
+    'KDE_exact' : (lambda d: _outliers(main.KDE(d['values']), d), 10**5),
+    'KDE_binned' : (lambda d: _outliers(main.KDE(d['values'], method = 'binned'), d), 10**7),
+    'KDE_clusters' : (lambda d: _outliers(main.KDE(d['values'], method = 'binned', \
+                            preprocess = True, clusters = d['clusters']), d), 10**7),
+    'KDE_exact_clusters' : (lambda d: _outliers(main.KDE(d['values'], preprocess = True, \
+                            clusters = d['clusters'], processes = None), d), 10**5),
+    'LOF' : (lambda d: _outliers(main.find_outliers_using_LOF(d['values']), d), 10**7),
+    'LOF_clusters' : (lambda d: _outliers(main.find_outliers_using_LOF(d['values'], \
+                            preprocess = True, clusters = d['clusters']), d), 10**7),
+    'combined' : (lambda d: _outliers(np.flatnonzero(main.find_outliers_combined(d['values'], \
+                            95, 5, preprocess = True, clusters = d['clusters'], \
+                            method = 'binned')), d), 10**7),
+    'prepare_dataset' : (lambda d: {'features' : int(cl.prepare_dataset(d['uris'], \
+                            entity_types = d['entity_types']).shape[1])}, 10**6),
+    'find_best_gmm' : (lambda d: {'components' : int(cl.find_best_gmm(d['X'].toarray(), \
+                            n = 7).n_components)}, 10**5),
+}
+
+def make_dataset(n, needs, random_state = 0, **options):
+    """Generates the inputs the given benchmarks need for n rows"""
+    values, errors = make_values(n, random_state = random_state, **options)
+    dataset = {'values' : values, 'errors' : errors}
+    if 'prepare_dataset' in needs or 'find_best_gmm' in needs:
+        dataset['clusters'], dataset['X'] = make_types(n, random_state = random_state)
+    else:
+        #The labels make_types draws first, without building the matrix
+        dataset['clusters'] = np.random.RandomState(random_state).randint(8, size = n)
+    if 'prepare_dataset' in needs:
+        dataset['uris'] = ["http://dbpedia.org/resource/Entity%d" % i for i in range(n)]
+        dataset['entity_types'] = entity_types_of(dataset['uris'], dataset['X'])
+    return dataset
+
+def measure(function, argument, repeat = 1):
+    """Runs function(argument) repeat times, it returns the fastest time, the
+    peak memory allocated while it ran (tracemalloc, which counts the numpy
+    arrays with numpy 1.13 or later) and the result of the last run."""
+    times = []
+    peak = 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = function(argument)
+        times.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return min(times), peak, result
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr = subprocess.DEVNULL, \
+                        cwd = os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(names = None, sizes = DEFAULT_SIZES, repeat = 1, distribution = 'lognormal', \
+                                                                random_state = 0):
+    """This function runs the benchmarks on synthetic datasets of every size.
+
+        The arguments are
+        names : The benchmarks to run, by default all of BENCHMARKS
+        sizes : The numbers of rows, a benchmark is skipped on sizes above \
+                                                        its limit
+        repeat : The number of runs per measurement, the fastest is kept
+        distribution, random_state : Passed on to make_values
+
+        The datasets only depend on the size and the seed, so runs on
+        different commits measure the same data. It returns a dictionary with
+        the environment and one result per benchmark and size.
+    """
+    names = list(BENCHMARKS) if names is None else names
+    results = []
+    for n in sizes:
+        active = [name for name in names if n <= BENCHMARKS[name][1]]
+        if not active:
+            continue
+        dataset = make_dataset(n, active, random_state = random_state, distribution = distribution)
+        for name in active:
+            seconds, peak, result = measure(BENCHMARKS[name][0], dataset, repeat)
+            print("%-16s %9d rows %10.4f s %12d bytes" % (name, n, seconds, peak))
+            record = {'benchmark' : name, 'rows' : n, 'seconds' : seconds, 'peak_bytes' : peak}
+            record.update(result)
+            results.append(record)
+    return {
+        'commit' : _commit(),
+        'created' : time.time(),
+        'python' : sys.version.split()[0],
+        'numpy' : np.__version__,
+        'platform' : platform.platform(),
+        'distribution' : distribution,
+        'random_state' : random_state,
+        'repeat' : repeat,
+        'results' : results,
+    }
+
+def compare(old, new, tolerance = 0.1):
+    """This function prints the change in time and memory of every benchmark
+    between two result files (old and new are dictionaries as returned by
+    run_benchmarks) and returns the (benchmark, rows) pairs which got slower
+    by more than the tolerance."""
+    before = dict(((each['benchmark'], each['rows']), each) for each in old['results'])
+    slower = []
+    for each in new['results']:
+        key = (each['benchmark'], each['rows'])
+        if key not in before:
+            continue
+        time_ratio = each['seconds']/max(before[key]['seconds'], 1e-9)
+        memory_ratio = each['peak_bytes']/float(max(before[key]['peak_bytes'], 1))
+        print("%-16s %9d rows time x%6.2f memory x%6.2f" % (key[0], key[1], time_ratio, memory_ratio))
+        if time_ratio > 1 + tolerance:
+            slower.append(key)
+    return slower
+
+
+if __name__=="__main__":
+    #python3 benchmark.py --sizes 1000 100000 --output benchmark.json --compare previous.json
+    parser = argparse.ArgumentParser(description = "Benchmarks the detectors and the clustering on synthetic data")
+    parser.add_argument('--benchmarks', nargs = '+', choices = sorted(BENCHMARKS))
+    parser.add_argument('--sizes', nargs = '+', type = int, default = DEFAULT_SIZES)
+    parser.add_argument('--repeat', type = int, default = 1)
+    parser.add_argument('--distribution', choices = ['lognormal', 'pareto'], default = 'lognormal')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', default = 'benchmark.json')
+    parser.add_argument('--compare', help = "A previous output file to compare with")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.benchmarks, args.sizes, args.repeat, args.distribution, args.seed)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent = 1)
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(json.load(f), report)
+        if slower:
+            print("Slower than before:", ", ".join("%s (%d rows)" % each for each in slower))
+            sys.exit(1)
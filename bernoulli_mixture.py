@@ -0,0 +1,102 @@
+import numpy as np
+from scipy import sparse
+
+
+def _logsumexp(a):
+    top = a.max(axis = 1)
+    return top + np.log(np.exp(a - top[:, np.newaxis]).sum(axis = 1))
+
+
+class BernoulliMixture(object):
+    """A mixture of multivariate Bernoulli distributions for 0/1 feature vectors.
+
+        This is the natural model for the type indicator vectors of
+        clustering.prepare_dataset. It works directly on a scipy sparse
+        matrix: the log likelihood of a batch is one sparse matrix product,
+        so one pass over the data costs O(nnz * n_components). The model is
+        fitted with stepwise (online) EM on mini batches of batch_size rows,
+        which is plain EM when a batch covers the whole dataset.
+
+        The arguments are
+        n_components : The number of clusters
+        batch_size : The number of rows in one EM step
+        n_epochs : The maximum number of passes over the data
+        tol : The search stops when an epoch improves the mean log likelihood \
+                                                            by less than tol
+        eps : The probabilities are kept within [eps, 1 - eps]
+        random_state : The seed for the initialisation and the batches
+
+        The attributes after fitting are weights_ (n_components) and
+        probs_ (n_components x n_features).
+    """
+
+    def __init__(self, n_components = 2, batch_size = 10000, n_epochs = 20, tol = 1e-4, \
+                                                eps = 1e-6, random_state = 0):
+        self.n_components = n_components
+        self.batch_size = batch_size
+        self.n_epochs = n_epochs
+        self.tol = tol
+        self.eps = eps
+        self.random_state = random_state
+
+    def _set_parameters(self, weights, probs):
+        self.weights_ = weights/weights.sum()
+        self.probs_ = np.clip(probs, self.eps, 1 - self.eps)
+        self._log_odds = np.log(self.probs_) - np.log1p(-self.probs_)
+        self._log_base = np.log(self.weights_) + np.log1p(-self.probs_).sum(axis = 1)
+
+    def _joint_log_likelihood(self, X):
+        return np.asarray(X.dot(self._log_odds.T)) + self._log_base
+
+    def _batches(self, X):
+        for start in range(0, X.shape[0], self.batch_size):
+            yield X[start:start + self.batch_size]
+
+    def fit(self, X):
+        X = sparse.csr_matrix(X)
+        n, d = X.shape
+        rng = np.random.RandomState(self.random_state)
+        mean = np.asarray(X.mean(axis = 0)).ravel()
+        seeds = X[rng.choice(n, self.n_components, replace = n < self.n_components)].toarray()
+        self._set_parameters(np.ones(self.n_components), 0.5*seeds + 0.5*mean)
+
+        #Running averages of the sufficient statistics
+        s_weights = self.weights_.copy()
+        s_probs = self.probs_*s_weights[:, np.newaxis]
+        step = 0
+        previous = -np.inf
+        for epoch in range(self.n_epochs):
+            order = rng.permutation(n)
+            for start in range(0, n, self.batch_size):
+                batch = X[order[start:start + self.batch_size]]
+                joint = self._joint_log_likelihood(batch)
+                resp = np.exp(joint - _logsumexp(joint)[:, np.newaxis])
+                eta = 1.0 if self.batch_size >= n else (step + 2)**-0.7
+                step += 1
+                s_weights = (1 - eta)*s_weights + eta*resp.mean(axis = 0)
+                s_probs = (1 - eta)*s_probs + eta*np.asarray(batch.T.dot(resp)).T/batch.shape[0]
+                self._set_parameters(s_weights, s_probs/np.maximum(s_weights, 1e-300)[:, np.newaxis])
+            current = self.score(X)
+            if current - previous < self.tol:
+                break
+            previous = current
+        return self
+
+    def score_samples(self, X):
+        X = sparse.csr_matrix(X)
+        return np.concatenate([_logsumexp(self._joint_log_likelihood(batch)) \
+                                    for batch in self._batches(X)])
+
+    def score(self, X):
+        """Returns the mean log likelihood of the rows of X"""
+        return self.score_samples(X).mean()
+
+    def predict(self, X):
+        X = sparse.csr_matrix(X)
+        return np.concatenate([self._joint_log_likelihood(batch).argmax(axis = 1) \
+                                    for batch in self._batches(X)])
+
+    def bic(self, X):
+        n, d = X.shape
+        parameters = self.n_components*d + self.n_components - 1
+        return -2*self.score(X)*n + parameters*np.log(n)
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+#Strings and IRIs are kept as they are, whitespace and comments elsewhere
+#are collapsed into a single space
+_TOKENS = re.compile(r'("""[\s\S]*?"""|\'\'\'[\s\S]*?\'\'\'|"(?:[^"\\\n]|\\.)*"'
+                     r'|\'(?:[^\'\\\n]|\\.)*\'|<[^<>"{}|^`\\\s]*>)|((?:\s|#[^\n]*)+)')
+
+
+class CacheMiss(Exception):
+    pass
+
+
+def normalize_query(query):
+    """This function normalizes the text of a query, so queries which only
+    differ in whitespace, indentation or comments share a cache entry."""
+    return _TOKENS.sub(lambda m: m.group(1) or ' ', query).strip()
+
+def query_key(endpoint, query, format = 'json'):
+    """Returns the content address of a query on an endpoint"""
+    return hashlib.sha256((endpoint + "\n" + format + "\n" + \
+                                normalize_query(query)).encode('utf-8')).hexdigest()
+
+
+class QueryCache(object):
+    """A persistent cache for the results of SPARQL queries.
+
+        The results are stored zlib compressed in a SQLite file, keyed on the
+        normalized query text, the endpoint and the result format.
+
+        The arguments are
+        path : The SQLite file, it is created if it does not exist
+        ttl : The number of seconds after which a result is fetched again \
+                                        (None keeps results forever)
+        max_bytes : The maximum size of the stored results, the least \
+                            recently used results are evicted beyond it
+        offline : If True, results are never fetched. Every stored result \
+                    is used (even an expired one) and a missing result \
+                    raises CacheMiss.
+    """
+
+    def __init__(self, path, ttl = 7*24*3600, max_bytes = 2*1024**3, offline = False):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread = False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY, endpoint TEXT, query TEXT,
+                created REAL, accessed REAL, size INTEGER, value BLOB)""")
+        self._connection.execute("""
+            CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)""")
+        self._connection.commit()
+
+    def get(self, endpoint, query, format = 'json'):
+        """Returns the stored result of the query, or None"""
+        key = query_key(endpoint, query, format)
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT created, value FROM results WHERE key = ?", \
+                                            (key,)).fetchone()
+            if row is None:
+                return None
+            if not self.offline and self.ttl is not None and now - row[0] > self.ttl:
+                self._connection.execute("DELETE FROM results WHERE key = ?", (key,))
+                self._connection.commit()
+                return None
+            self._connection.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+        return json.loads(zlib.decompress(row[1]).decode('utf-8'))
+
+    def put(self, endpoint, query, result, format = 'json'):
+        """Stores the result of a query and evicts the least recently used
+        results if the cache grows beyond max_bytes"""
+        value = zlib.compress(json.dumps(result, separators = (',', ':')).encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)", \
+                        (query_key(endpoint, query, format), endpoint, normalize_query(query), \
+                                        now, now, len(value), sqlite3.Binary(value)))
+            total = self._connection.execute("SELECT SUM(size) FROM results").fetchone()[0]
+            if self.max_bytes is not None and total > self.max_bytes:
+                evict = []
+                for key, size in self._connection.execute(\
+                                "SELECT key, size FROM results ORDER BY accessed"):
+                    if total <= self.max_bytes:
+                        break
+                    evict.append((key,))
+                    total -= size
+                self._connection.executemany("DELETE FROM results WHERE key = ?", evict)
+            self._connection.commit()
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM results")
+            self._connection.commit()
+
+    def close(self):
+        self._connection.close()
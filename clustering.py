@@ -1,13 +1,23 @@
 
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 import get_data as gd
 import numpy as np
+from scipy import sparse
 from sklearn import mixture
+from sklearn.cluster import MiniBatchKMeans
+from bernoulli_mixture import BernoulliMixture
+import instrumentation
 
-def get_all_types(ordered_entities):
+@instrumentation.traced('type_lookup')
+def get_all_types(ordered_entities, batch_size = 50, max_workers = 4):
     """This function will get all the types related with a URI.
         The arguments are:
         ordered_entities: This is a list containing all the entities whose 
         types have to be extracted"
+        batch_size, max_workers : The number of entities per query and the \
+            number of concurrent queries, see get_data.get_types_batch
         
         It will return the following two things:
         entity_type : A dictionary which has list of each entity and types
@@ -16,17 +26,15 @@ def get_all_types(ordered_entities):
         it has occured.
     """
     all_types = {}
-    entity_type = {}
+    entity_type = gd.get_types_batch(ordered_entities, batch_size = batch_size, \
+                                            max_workers = max_workers)
+    #The distinct entities which were fetched, as counted by TypeIndex.update
+    instrumentation.count('entities_typed', len(entity_type))
     for each in ordered_entities:
-        entity_type_each_list = []
-        results = gd.get_types("<" + each + ">")['results']['bindings']
-        for each_type in results:
-            _type = each_type['concept']['value']
+        for _type in entity_type[each]:
             if _type not in all_types:
                 all_types[_type] = 0
             all_types[_type]+=1
-            entity_type_each_list.append(_type)
-        entity_type[each] = entity_type_each_list
     return (entity_type, all_types)
     
 def discard_p(all_types, total_entities, p = 0.05):
@@ -58,48 +66,231 @@ def feature_index_map(all_types, discards):
             index+=1      
     return features_index_map_d
     
-def prepare_dataset(ordered_entities, p = 0.05):
-    entity_type, all_types = get_all_types(ordered_entities)
+@instrumentation.traced('feature_matrix')
+def prepare_dataset(ordered_entities, p = 0.05, entity_types = None, index = None):
+    """This function builds the type feature matrix of the entities.
+
+        The arguments are
+        ordered_entities : The list (or columns.StringTable) of entity URIs
+        p : The types on more than (1-p) or less than p of the entities are \
+                                                            discarded
+        entity_types : The (entity_type, all_types) pair of get_all_types, \
+                    it is fetched from DBPedia if it is None
+        index : A type_index.TypeIndex, if given only the types of the \
+                    entities missing from it are fetched (and added to it) \
+                    and the matrix is built from the index
+
+        It returns a scipy CSR matrix of uint8 with one row per entity and
+        a 1 for every (kept) type of the entity, so only the types which
+        are present take memory.
+    """
+    if index is not None and entity_types is None:
+        index.update(ordered_entities)
+        entity_features, types = index.features(ordered_entities, p, return_types = True)
+        print(dict((each, i) for i, each in enumerate(types)))
+        return entity_features
+    if entity_types is None:
+        entity_types = get_all_types(ordered_entities)
+    entity_type, all_types = entity_types
     discards = discard_p(all_types, len(all_types), p)
     feature_map = feature_index_map(all_types, discards)
-    data_feature = np.zeros(shape = (len(ordered_entities), len(feature_map)), dtype = int)
     print(feature_map)
-    for i in range(len(ordered_entities)):
-        for j in entity_type[ordered_entities[i]]:
-            try:
-                data_feature[i][feature_map[j]] = 1
-            except Exception as e:
-                pass
-                #print("Feature Removed Because of p constraints")
-    return data_feature
+
+    #One row per distinct entity, the types removed by discard_p get column -1
+    entities = list(entity_type)
+    lengths = np.fromiter((len(entity_type[each]) for each in entities), \
+                                        dtype = np.int64, count = len(entities))
+    columns = np.fromiter((feature_map.get(_type, -1) for each in entities \
+                    for _type in entity_type[each]), dtype = np.int64, count = lengths.sum())
+    rows = np.repeat(np.arange(len(entities)), lengths)
+    kept = columns >= 0
+    entity_features = sparse.csr_matrix((np.ones(kept.sum(), dtype = np.uint8), \
+            (rows[kept], columns[kept])), shape = (len(entities), len(feature_map)))
+
+    row_of = {each : i for i, each in enumerate(entities)}
+    return entity_features[np.fromiter((row_of[each] for each in ordered_entities), \
+                                    dtype = np.int64, count = len(ordered_entities))]
     
-def find_best_gmm(X,n = 7):
+def _fit_gmm(X, cv_type, n_components, init = None, random_state = 0):
+    """Fits one candidate and returns it with its BIC and its wall-clock time.
+    init is None for the k-means initialisation, or the (weights, means,
+    precisions) EM starts from, in which case no k-means is run."""
+    start = time.time()
+    if init is None:
+        gmm = mixture.GaussianMixture(n_components=n_components,
+                                      covariance_type=cv_type,
+                                      random_state=random_state)
+    else:
+        gmm = mixture.GaussianMixture(n_components=n_components,
+                                      covariance_type=cv_type,
+                                      init_params='random',
+                                      weights_init=init[0],
+                                      means_init=init[1],
+                                      precisions_init=init[2],
+                                      random_state=random_state)
+    gmm.fit(X)
+    return gmm, gmm.bic(X), time.time() - start
+
+def _fitted_parameters(gmm):
+    """The (weights, means, precisions) of a fitted GaussianMixture, the init of _fit_gmm"""
+    return gmm.weights_, gmm.means_, gmm.precisions_
+
+def _grown_parameters(gmm, X, share = 0.05):
+    """The parameters of gmm with one more component, for the warm start of
+    _search_cv_type: the new component is centred on the mean of the share
+    of the samples gmm explains worst, it gets that share of the weight and
+    the mean precision of the other components"""
+    scores = gmm.score_samples(X)
+    worst = X[scores <= np.percentile(scores, 100*share)].mean(axis = 0)
+    weights = np.append((1 - share)*gmm.weights_, share)
+    means = np.vstack((gmm.means_, worst))
+    precisions = gmm.precisions_
+    if gmm.covariance_type != 'tied':
+        precisions = np.concatenate((precisions, precisions.mean(axis = 0)[np.newaxis]))
+    return weights, means, precisions
+
+def _search_cv_type(X, cv_type, n_components_range, patience, random_state):
+    """This function fits the component counts of one covariance type one after
+    another. The first count uses the usual k-means initialisation, every
+    following count is warm started from the weights, means and precisions
+    of the previous fit plus a component for the 5% of the samples it
+    explained worst (see _grown_parameters), so EM starts close to a solution
+    and no k-means run is needed. The search stops once the BIC has risen
+    patience times in a row."""
+    results = []
+    previous = None
+    rises = 0
+    for n_components in n_components_range:
+        init = None
+        if previous is not None:
+            init = _grown_parameters(previous[0], X)
+        gmm, bic, seconds = _fit_gmm(X, cv_type, n_components, init, random_state)
+        results.append((cv_type, n_components, gmm, bic, seconds))
+        if previous is not None and bic > previous[1]:
+            rises += 1
+            if rises >= patience:
+                break
+        else:
+            rises = 0
+        previous = (gmm, bic)
+    return results
+
+@instrumentation.traced('gmm_search')
+def find_best_gmm(X,n = 7, n_jobs = None, screen_size = 5000, refit_top = 3, \
+                                                patience = 2, random_state = 0):
     """This function attempt to find the best GMM for a 
     given dataset. It tries to find the best no of clusters
     and the different cv_types
     The arguments are:
     1. X which is the dataset
-    2. n which is the number of clusters upto which it needs to check"""
-    
-    lowest_bic = np.infty
-    bic = []
-    n_components_range = range(1, n)
+    2. n which is the number of clusters upto which it needs to check
+    3. n_jobs which is the number of processes (by default one per cv_type)
+    4. screen_size which is the size of the random subsample used to screen
+       the candidates, the refit_top best candidates are then fitted again
+       on the whole dataset, starting from their screened parameters
+    5. patience which is the number of consecutive BIC increases after
+       which larger component counts are not tried
+    GaussianMixture only works on dense data, so a sparse X is densified
+    The wall-clock time and BIC of every candidate are printed."""
+    if sparse.issparse(X):
+        X = X.toarray()
+    rng = np.random.RandomState(random_state)
+    screen = X
+    if X.shape[0] > screen_size:
+        screen = X[rng.choice(X.shape[0], screen_size, replace = False)]
+    n_components_range = range(1, min(n, screen.shape[0] + 1))
     cv_types = ['spherical', 'tied', 'diag', 'full']
-    for cv_type in cv_types:
-        for n_components in n_components_range:
-            # Fit a Gaussian mixture with EM
-            gmm = mixture.GaussianMixture(n_components=n_components,
-                                          covariance_type=cv_type)
-            gmm.fit(X)
-            bic.append(gmm.bic(X))
-            if bic[-1] < lowest_bic:
-                lowest_bic = bic[-1]
-                best_gmm = gmm
-    return best_gmm
-
-
-def cluster(ordered_entities, p =0.05):
-    """This is the final function which is used to cluster"""
-    ds = prepare_dataset(ordered_entities, p = p)
-    best_gmm = find_best_gmm(ds, 10)
-    return best_gmm.predict(ds)
+    if n_jobs is None:
+        n_jobs = min(len(cv_types), os.cpu_count() or 1)
+
+    with ProcessPoolExecutor(max_workers = n_jobs) as executor:
+        screened = []
+        for results in executor.map(_search_cv_type, [screen]*len(cv_types), cv_types, \
+                [n_components_range]*len(cv_types), [patience]*len(cv_types), \
+                                                    [random_state]*len(cv_types)):
+            screened.extend(results)
+        for cv_type, n_components, gmm, bic, seconds in screened:
+            print("%-9s %2d components BIC = %14.2f %8.3f s" % \
+                                        (cv_type, n_components, bic, seconds))
+        screened.sort(key = lambda each: each[3])
+        if screen is X:
+            return screened[0][2]
+
+        top = screened[:refit_top]
+        refits = list(executor.map(_fit_gmm, [X]*len(top), [each[0] for each in top], \
+                [each[1] for each in top], [_fitted_parameters(each[2]) for each in top], \
+                                                    [random_state]*len(top)))
+    for (cv_type, n_components, _, _, _), (gmm, bic, seconds) in zip(top, refits):
+        print("%-9s %2d components BIC = %14.2f %8.3f s (full data)" % \
+                                        (cv_type, n_components, bic, seconds))
+    return min(refits, key = lambda each: each[1])[0]
+
+
+@instrumentation.traced('bernoulli_search')
+def find_best_bernoulli(X, n = 7, patience = 2, **options):
+    """This function finds the best BernoulliMixture for a dataset of 0/1
+    features (dense or sparse) by its BIC, trying 1 to n-1 components and
+    stopping once the BIC has risen patience times in a row. The options
+    are passed on to BernoulliMixture."""
+    best_model = None
+    lowest_bic = np.inf
+    previous_bic = np.inf
+    rises = 0
+    for n_components in range(1, n):
+        start = time.time()
+        model = BernoulliMixture(n_components = n_components, **options).fit(X)
+        bic = model.bic(X)
+        print("bernoulli %2d components BIC = %14.2f %8.3f s" % \
+                                        (n_components, bic, time.time() - start))
+        if bic < lowest_bic:
+            lowest_bic = bic
+            best_model = model
+        rises = rises + 1 if bic > previous_bic else 0
+        if rises >= patience:
+            break
+        previous_bic = bic
+    return best_model
+
+def _cluster_gmm(X, n, **options):
+    X = X.toarray()
+    return find_best_gmm(X, n, **options).predict(X)
+
+def _cluster_bernoulli(X, n, **options):
+    return find_best_bernoulli(X, n, **options).predict(X)
+
+def _cluster_minibatch_kmeans(X, n, batch_size = 10000, random_state = 0):
+    kmeans = MiniBatchKMeans(n_clusters = n, batch_size = batch_size, \
+                                                    random_state = random_state)
+    return kmeans.fit_predict(X)
+
+#'gmm' is the Gaussian mixture of the paper, it needs the dense feature matrix.
+#'bernoulli' and 'minibatch_kmeans' work on the sparse matrix in mini batches.
+CLUSTERING_BACKENDS = {
+    'gmm' : _cluster_gmm,
+    'bernoulli' : _cluster_bernoulli,
+    'minibatch_kmeans' : _cluster_minibatch_kmeans,
+}
+
+def cluster(ordered_entities, p =0.05, backend = 'gmm', n = 10, index = None, **options):
+    """This is the final function which is used to cluster
+
+        The arguments are
+        ordered_entities : The list (or columns.StringTable) of entity URIs
+        p : The threshold of discard_p
+        backend : One of CLUSTERING_BACKENDS ('gmm', 'bernoulli' or \
+                                                        'minibatch_kmeans')
+        n : The number of clusters up to which the model search checks, \
+                    for 'minibatch_kmeans' the number of clusters
+        index : An optional type_index.TypeIndex, see prepare_dataset
+        options : Passed on to the backend
+
+        It returns the cluster label of every entity.
+    """
+    if backend not in CLUSTERING_BACKENDS:
+        raise ValueError("Unknown clustering backend %r, expected one of %s" % \
+                                (backend, ", ".join(sorted(CLUSTERING_BACKENDS))))
+    ds = prepare_dataset(ordered_entities, p = p, index = index)
+    with instrumentation.span('clustering', backend = backend):
+        labels = CLUSTERING_BACKENDS[backend](ds, n, **options)
+    instrumentation.count('clusters', np.unique(labels).size)
+    return labels
@@ -0,0 +1,338 @@
+import csv
+import io
+import re
+from array import array
+import numpy as np
+
+
+class StringTable(object):
+    """A compact table of strings (the entity URIs).
+
+        All the strings are stored UTF-8 encoded one after another in a single
+        byte buffer, string k being data[offsets[k]:offsets[k + 1]]. Rows are
+        mapped to strings through codes, so a URI which occurs in many rows is
+        stored once. Indexing a row returns a str, so the table can be used in
+        place of the list of URIs, and take() selects rows without copying
+        the strings.
+
+        The arguments are
+        data : The numpy uint8 array of the encoded strings
+        offsets : The numpy int64 array of the string boundaries (length k + 1)
+        codes : The string of every row, if None row i is string i
+    """
+
+    def __init__(self, data, offsets, codes = None):
+        self.data = data
+        self.offsets = offsets
+        self.codes = np.arange(offsets.size - 1) if codes is None else codes
+
+    @classmethod
+    def from_strings(cls, strings):
+        builder = ColumnBuilder()
+        for each in strings:
+            builder.append_string(each)
+        return builder.build_strings()
+
+    def __len__(self):
+        return self.codes.size
+
+    def __getitem__(self, i):
+        code = self.codes[i]
+        return self.data[self.offsets[code]:self.offsets[code + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        data = self.data.tobytes()
+        offsets = self.offsets.tolist()
+        for code in self.codes.tolist():
+            yield data[offsets[code]:offsets[code + 1]].decode('utf-8')
+
+    def take(self, indices):
+        """Returns a table of the given rows, sharing the string buffer"""
+        return StringTable(self.data, self.offsets, self.codes[indices])
+
+    def tolist(self):
+        return list(self)
+
+    def lines(self, indices = None, separator = b"\n"):
+        """Returns the encoded strings of the given rows (all by default), each
+        followed by separator, as one bytes object. The bytes are gathered
+        from the buffer with one vectorized copy, without a str per row."""
+        codes = self.codes if indices is None else self.codes[np.asarray(indices, dtype = np.intp)]
+        starts = self.offsets[codes]
+        lengths = self.offsets[codes + 1] - starts
+        if not separator:
+            starts, lengths = starts[lengths > 0], lengths[lengths > 0]
+        size = lengths + len(separator)
+        if size.sum() == 0:
+            return b""
+        #The separator is appended to the buffer at position end, so every output
+        #byte is source[step.cumsum()] where step is 1 except where a string or
+        #a separator starts
+        end = self.data.size
+        source = np.concatenate((self.data, np.frombuffer(separator, dtype = np.uint8)))
+        begins = np.cumsum(size) - size
+        step = np.ones(size.sum(), dtype = np.intp)
+        previous = np.zeros(starts.size, dtype = np.intp)
+        if separator:
+            previous[1:] = end + len(separator) - 1
+            written = lengths > 0
+            step[(begins + lengths)[written]] = end - (starts + lengths - 1)[written]
+        else:
+            previous[1:] = starts[:-1] + lengths[:-1] - 1
+        step[begins] = np.where(lengths > 0, starts, end) - previous
+        return source[np.cumsum(step)].tobytes()
+
+    def concatenate(self, other):
+        """Returns a table of the rows of self followed by the rows of other"""
+        size = self.offsets[-1]
+        return StringTable(np.concatenate((self.data[:size], other.data[:other.offsets[-1]])), \
+                    np.concatenate((self.offsets, size + other.offsets[1:])), \
+                    np.concatenate((self.codes, other.codes + self.offsets.size - 1)))
+
+    def compact(self):
+        """Returns a table with only the strings its rows use, e.g. after take()"""
+        used, codes = np.unique(self.codes, return_inverse = True)
+        lengths = self.offsets[used + 1] - self.offsets[used]
+        data = np.frombuffer(StringTable(self.data, self.offsets, used).lines(separator = b""), \
+                                                                    dtype = np.uint8)
+        return StringTable(data, np.concatenate(([0], np.cumsum(lengths))), codes.reshape(-1))
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.offsets.nbytes + self.codes.nbytes
+
+
+#The multiplier of the polynomial hash of string_hashes and the constants of
+#the SplitMix64 finalizer which mixes its bits
+_HASH_MULTIPLIER = np.uint64(0x100000001b3)
+_MIX = (np.uint64(0xbf58476d1ce4e5b9), np.uint64(0x94d049bb133111eb))
+_HASH_BYTES = 1 << 24
+
+def _mix(z):
+    z = (z ^ (z >> np.uint64(30)))*_MIX[0]
+    z = (z ^ (z >> np.uint64(27)))*_MIX[1]
+    return z ^ (z >> np.uint64(31))
+
+def string_hashes(uris):
+    """This function returns a 64-bit hash of the string of every row.
+
+        uris is a StringTable (or a list of strings). The bytes of every
+        string are hashed as a polynomial modulo 2**64, vectorized over the
+        byte buffer _HASH_BYTES at a time, and the hash and the length are
+        mixed with the SplitMix64 finalizer. Equal strings have equal
+        hashes; different strings with equal hashes are found by
+        check_hashes. The hashes take 8 bytes per row whatever the length
+        of the strings, so they are used as the keys of the URIs.
+    """
+    if not isinstance(uris, StringTable):
+        uris = StringTable.from_strings(uris)
+    offsets = uris.offsets.astype(np.int64)
+    lengths = np.diff(offsets)
+    powers = np.cumprod(np.full(max(int(lengths.max()) if lengths.size else 0, 1), \
+                                                _HASH_MULTIPLIER, dtype = np.uint64))
+    hashes = np.empty(lengths.size, dtype = np.uint64)
+    first = 0
+    with np.errstate(over = 'ignore'):
+        while first < lengths.size:
+            #The strings first:last have at most _HASH_BYTES bytes (or are one string)
+            last = max(int(np.searchsorted(offsets, offsets[first] + _HASH_BYTES, side = 'right')) - 1, \
+                                                                        first + 1)
+            low, high = offsets[first], offsets[last]
+            position = np.arange(high - low) - np.repeat(offsets[first:last] - low, lengths[first:last])
+            terms = (uris.data[low:high].astype(np.uint64) + np.uint64(1))*powers[position]
+            total = np.concatenate(([np.uint64(0)], np.cumsum(terms, dtype = np.uint64)))
+            hashes[first:last] = total[offsets[first + 1:last + 1] - low] - total[offsets[first:last] - low]
+            first = last
+        hashes = _mix(hashes ^ _mix(lengths.astype(np.uint64) + np.uint64(1)))
+    return hashes[uris.codes]
+
+def check_hashes(uris, hashes):
+    """This function raises a ValueError if two rows of a StringTable with
+    different strings have the same hash. The rows with equal hashes are
+    compared byte for byte in one vectorized gather."""
+    order = np.argsort(hashes, kind = 'stable')
+    equal = hashes[order[1:]] == hashes[order[:-1]]
+    first, second = order[:-1][equal], order[1:][equal]
+    different = uris.codes[first] != uris.codes[second]
+    first, second = first[different], second[different]
+    if first.size == 0:
+        return
+    lengths = np.diff(uris.offsets)
+    if np.any(lengths[uris.codes[first]] != lengths[uris.codes[second]]) or \
+            uris.lines(first, separator = b"") != uris.lines(second, separator = b""):
+        raise ValueError("Two different URIs have the same 64-bit hash")
+
+
+class ColumnBuilder(object):
+    """This class collects (URI, value) rows into a float64 value column and
+    a StringTable of the URIs.
+
+        Rows are appended one at a time into growing typed buffers, so no
+        Python object is kept per row. Consecutive rows with the same URI
+        (as the rows of get_data.iter_property_values, which come sorted by
+        URI) share one entry of the string table.
+    """
+
+    def __init__(self):
+        self._values = array('d')
+        self._codes = array('q')
+        self._offsets = array('q', [0])
+        self._data = bytearray()
+        self._last = None
+
+    def append_string(self, uri):
+        if uri != self._last:
+            self._data += uri.encode('utf-8')
+            self._offsets.append(len(self._data))
+            self._last = uri
+        self._codes.append(len(self._offsets) - 2)
+
+    def append(self, uri, value):
+        self.append_string(uri)
+        self._values.append(value)
+
+    def __len__(self):
+        return len(self._codes)
+
+    def build_strings(self):
+        return StringTable(np.frombuffer(bytes(self._data), dtype = np.uint8), \
+                    np.frombuffer(self._offsets, dtype = np.int64), \
+                    np.frombuffer(self._codes, dtype = np.int64))
+
+    def extend(self, uris, values):
+        """Appends rows from a sequence of URIs and a numpy array of values"""
+        for each in uris:
+            self.append_string(each)
+        self._values.frombytes(np.ascontiguousarray(values, dtype = np.float64).tobytes())
+
+    def build(self):
+        """Returns the value column and the StringTable of the URIs"""
+        return np.frombuffer(self._values, dtype = np.float64), self.build_strings()
+
+
+XSD = "http://www.w3.org/2001/XMLSchema#"
+
+_ESCAPE = re.compile(r'\\(.)')
+_UNESCAPED = {'t' : '\t', 'n' : '\n', 'r' : '\r'}
+
+def _tsv_term(term):
+    """Splits a term of a SPARQL TSV result into its value and datatype"""
+    if term.startswith('<'):
+        return term[1:-1], None
+    if term.startswith('"'):
+        end = term.rfind('"')
+        value = _ESCAPE.sub(lambda m: _UNESCAPED.get(m.group(1), m.group(1)), term[1:end])
+        suffix = term[end + 1:]
+        return value, suffix[3:-1] if suffix.startswith('^^<') else None
+    #Numbers may be written without quotes
+    if 'e' in term or 'E' in term:
+        return term, XSD + "double"
+    return term, XSD + ("decimal" if '.' in term else "integer")
+
+def rows_from_json(result, variables = ('entity', 'value')):
+    """Returns the rows of a SPARQL JSON result as (entity, value, datatype) tuples"""
+    key, value = variables
+    return [(each[key]['value'], each[value]['value'], each[value].get('datatype')) \
+                                        for each in result['results']['bindings']]
+
+def rows_from_csv(result, variables = ('entity', 'value')):
+    """Returns the rows of a SPARQL CSV result, which has no datatypes"""
+    reader = csv.reader(io.StringIO(result))
+    header = next(reader, [])
+    key, value = header.index(variables[0]), header.index(variables[1])
+    return [(each[key], each[value], None) for each in reader if each]
+
+def rows_from_tsv(result, variables = ('entity', 'value')):
+    """Returns the rows of a SPARQL TSV result as (entity, value, datatype) tuples"""
+    lines = result.splitlines()
+    if not lines:
+        return []
+    header = [each.lstrip('?') for each in lines[0].split('\t')]
+    key, value = header.index(variables[0]), header.index(variables[1])
+    rows = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        terms = line.split('\t')
+        rows.append((_tsv_term(terms[key])[0],) + _tsv_term(terms[value]))
+    return rows
+
+#The codes of the error column of parse_literals
+PARSE_OK = 0
+PARSE_SYNTAX = 1
+PARSE_DATATYPE = 2
+PARSE_NOT_FINITE = 3
+PARSE_ERRORS = ('ok', 'not a number', 'not a numeric datatype', 'not finite')
+
+#Literals of these datatypes are never read as numbers
+NON_NUMERIC_DATATYPES = frozenset(XSD + each for each in ('date', 'dateTime', 'time', \
+                'duration', 'gYear', 'gYearMonth', 'gMonthDay', 'gMonth', 'gDay', 'boolean', 'anyURI', \
+                'hexBinary', 'base64Binary'))
+
+_THOUSANDS = re.compile(r'^\s*[+-]?\d{1,3}(,\d{3})+(\.\d*)?\s*$')
+
+def _to_float(text):
+    """Converts an array of strings to float64 in one cast. If some strings are
+    not numbers the array is split in halves until they are isolated, so a
+    few bad literals only cost O(log n) more casts each."""
+    try:
+        return text.astype(np.float64), np.ones(text.size, dtype = bool)
+    except ValueError:
+        if text.size == 1:
+            return np.full(1, np.nan), np.zeros(1, dtype = bool)
+    middle = text.size//2
+    (low, low_ok), (high, high_ok) = _to_float(text[:middle]), _to_float(text[middle:])
+    return np.concatenate((low, high)), np.concatenate((low_ok, high_ok))
+
+def parse_literals(lexical, datatypes = None):
+    """This function converts a column of numeric literals to float64.
+
+        The arguments are
+        lexical : The lexical forms of the literals (a sequence of strings)
+        datatypes : The datatype URI of every literal, None for plain \
+                    literals (e.g. of a CSV result), by default all None
+
+        Integers, decimals and doubles (including scientific notation) of
+        any numeric datatype (xsd or the unit datatypes of DBPedia) are read
+        in a single cast of the whole column. Thousands separators
+        ("1,234,567") are removed first, the few literals with a comma are
+        checked with a regular expression. Literals with an underscore and
+        literals of NON_NUMERIC_DATATYPES (e.g. xsd:gYear) are not read.
+
+        It returns the float64 array of the values (nan where the literal
+        could not be read) and a uint8 error column with one of PARSE_OK,
+        PARSE_SYNTAX, PARSE_DATATYPE and PARSE_NOT_FINITE per literal (see
+        PARSE_ERRORS).
+    """
+    text = np.array(lexical, dtype = str) if len(lexical) else np.zeros(0, dtype = 'U1')
+    values = np.full(text.size, np.nan)
+    errors = np.zeros(text.size, dtype = np.uint8)
+    if datatypes is not None and text.size:
+        kinds, inverse = np.unique(np.array([each or '' for each in datatypes], dtype = str), \
+                                                            return_inverse = True)
+        rejected = np.array([each in NON_NUMERIC_DATATYPES for each in kinds])[inverse]
+        errors[rejected] = PARSE_DATATYPE
+
+    commas = np.flatnonzero(np.char.find(text, ',') >= 0)
+    if commas.size:
+        text = text.copy()
+        for i in commas:
+            if _THOUSANDS.match(text[i]):
+                text[i] = text[i].replace(',', '')
+
+    #The cast accepts Python's digit separators ("1_000"), xsd does not
+    errors[(errors == PARSE_OK) & (np.char.find(text, '_') >= 0)] = PARSE_SYNTAX
+    candidates = np.flatnonzero(errors == PARSE_OK)
+    parsed, ok = _to_float(text[candidates])
+    values[candidates] = parsed
+    errors[candidates[~ok]] = PARSE_SYNTAX
+    not_finite = candidates[ok & ~np.isfinite(parsed)]
+    errors[not_finite] = PARSE_NOT_FINITE
+    values[not_finite] = np.nan
+    return values, errors
+
+RESULT_READERS = {
+    'json' : rows_from_json,
+    'csv' : rows_from_csv,
+    'tsv' : rows_from_tsv,
+}
@@ -1,9 +1,22 @@
-from SPARQLWrapper import SPARQLWrapper, JSON
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Full
+from sparql_client import SPARQLClient, SPARQLError
+import numpy as np
+from columns import ColumnBuilder, RESULT_READERS, PARSE_OK, parse_literals
+import instrumentation
 
-def get_company_count():
-    sparql = SPARQLWrapper("http://dbpedia.org/sparql")
-    sparql.setReturnFormat(JSON)
-    country_pops = """
+#DBpedia returns at most this many rows for a single query
+MAX_ROWS = 10000
+
+#Characters which are not allowed inside <...> in a SPARQL query
+IRI_FORBIDDEN = set('<>"{}|^`\\ \n\t')
+
+#Boundaries which split the DBpedia resource URIs into ranges of similar size
+DBPEDIA_PARTITIONS = ["http://dbpedia.org/resource/" + each for each in "CFJMPS"]
+
+PREFIXES = """
     PREFIX owl: <http://www.w3.org/2002/07/owl#>
     PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
     PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
@@ -16,164 +29,182 @@ def get_company_count():
     PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
     PREFIX dbo: <http://dbpedia.org/ontology/>
     PREFIX yago:<http://dbpedia.org/class/yago/>
+"""
 
-    SELECT (COUNT(?company_name) as ?count)
-    WHERE {
-        ?company_name a dbo:Company .
-        ?company_name dbo:numberOfEmployees ?population
-    }
-        """
-    sparql.setQuery(country_pops)  # the previous query as a literal string
-
-    results = sparql.query().convert()
-    return int(results['results']['bindings'][0]['count']['value'])
-
-    
-
-def get_company_population(parsing_exception_file):
-    total_companies = get_company_count()
-    sparql = SPARQLWrapper("http://dbpedia.org/sparql")
-    sparql.setReturnFormat(JSON)
-    ordered_pop = []
-    ordered_name = []
-    parsing_error = {}
-
-    for j in range(total_companies//10000 + 1):
-        country_pops = """
-        PREFIX owl: <http://www.w3.org/2002/07/owl#>
-        PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-        PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-        PREFIX foaf: <http://xmlns.com/foaf/0.1/>
-        PREFIX dc: <http://purl.org/dc/elements/1.1/>
-        PREFIX : <http://dbpedia.org/resource/>
-        PREFIX dbpedia2: <http://dbpedia.org/property/>
-        PREFIX dbpedia: <http://dbpedia.org/>
-        PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
-        PREFIX dbo: <http://dbpedia.org/ontology/>
-        PREFIX yago:<http://dbpedia.org/class/yago/>
-
-        SELECT ?company_name ?company_population
-        WHERE {
-            ?company_name a dbo:Company .
-            ?company_name dbo:numberOfEmployees ?company_population
-        } 
-            ORDER BY ?company_name
-            OFFSET %d
-            """ %(j*10000)
-        sparql.setQuery(country_pops)  # the previous query as a literal string
-
-        results = sparql.query().convert()
-        spo_triples = results['results']['bindings']
-        for each in spo_triples:
-            try:
-                company_name = each['company_name']['value']
-                pop = int(each['company_population']['value'])
-                ordered_name.append(company_name)
-                ordered_pop.append(pop)
-            except Exception as e:
-                parsing_error[company_name] = each['company_population']['value']
-                pass
+_client = None
 
-    #Writing all the values which were not parsed properly to a file    
-    if len(parsing_error)!=0:
-        f = open(parsing_exception_file, "w")
-        for each in parsing_error:
-            f.write(each + ":" + parsing_error[each] + "\n")
-        f.close()
-        
-        
-    return (ordered_pop, ordered_name)
+def get_client():
+    """Returns the SPARQLClient used by all the functions of this module"""
+    global _client
+    if _client is None:
+        _client = SPARQLClient()
+    return _client
 
+def set_client(client):
+    """Sets the SPARQLClient (endpoint, cache, pool) used by this module"""
+    global _client
+    _client = client
 
+def _string_literal(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
 
-def get_types(entity_URI):
-    query ="""
-    PREFIX owl: <http://www.w3.org/2002/07/owl#>
-    PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-    PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-    PREFIX foaf: <http://xmlns.com/foaf/0.1/>
-    PREFIX dc: <http://purl.org/dc/elements/1.1/>
-    PREFIX : <http://dbpedia.org/resource/>
-    PREFIX dbpedia2: <http://dbpedia.org/property/>
-    PREFIX dbpedia: <http://dbpedia.org/>
-    PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
-    PREFIX dbo: <http://dbpedia.org/ontology/>
-    PREFIX yago:<http://dbpedia.org/class/yago/>
+def _fetch_partition(where, low, high, page_size, client, format, pages, stop):
+    """Walks one partition [low, high) of the entities with keyset pagination
+    and puts every page of rows into the pages queue."""
+    last = None
+    try:
+        while not stop.is_set():
+            conditions = []
+            if last is not None:
+                conditions.append("STR(?entity) >= " + _string_literal(last))
+            elif low is not None:
+                conditions.append("STR(?entity) >= " + _string_literal(low))
+            if high is not None:
+                conditions.append("STR(?entity) < " + _string_literal(high))
+            query = PREFIXES + """
+            SELECT ?entity ?value
+            WHERE {
+                %s
+                %s
+            }
+            ORDER BY STR(?entity)
+            LIMIT %d
+            """ % (where, "FILTER(" + " && ".join(conditions) + ")" if conditions else "", \
+                                                                            page_size)
+            rows = RESULT_READERS[format](client.query(query, format))
+            if len(rows) < page_size:
+                _put(pages, rows, stop)
+                break
+            #The rows of the last entity may continue on the next page, so that
+            #entity starts the next page instead
+            last = rows[-1][0]
+            complete = [each for each in rows if each[0] != last]
+            if not complete:
+                raise SPARQLError("More than %d rows for %s" % (page_size, last))
+            _put(pages, complete, stop)
+        _put(pages, None, stop)
+    except Exception as e:
+        _put(pages, e, stop)
 
-    SELECT DISTINCT ?concept
-    WHERE {
-        %s a ?concept .
-    }
-    """ % (entity_URI)
-    sparql = SPARQLWrapper("http://dbpedia.org/sparql")
-    sparql.setReturnFormat(JSON)
-    sparql.setQuery(query)  # the previous query as a literal string
-    return sparql.query().convert()
+def _put(pages, item, stop):
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout = 0.1)
+            return
+        except Full:
+            pass
 
-def get_country_population(parsing_exception_file):
-    sparql = SPARQLWrapper("http://dbpedia.org/sparql")
-    sparql.setReturnFormat(JSON)
-    
+def iter_property_pages(where, page_size = 10000, partitions = DBPEDIA_PARTITIONS, \
+                        max_workers = 4, prefetch = 4, format = 'json', client = None):
+    """This function streams the (entity, value) rows matched by a graph pattern,
+    one page (list of rows) at a time.
 
-    country_pops = """
-    PREFIX owl: <http://www.w3.org/2002/07/owl#>
-    PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-    PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-    PREFIX foaf: <http://xmlns.com/foaf/0.1/>
-    PREFIX dc: <http://purl.org/dc/elements/1.1/>
-    PREFIX : <http://dbpedia.org/resource/>
-    PREFIX dbpedia2: <http://dbpedia.org/property/>
-    PREFIX dbpedia: <http://dbpedia.org/>
-    PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
-    PREFIX dbo: <http://dbpedia.org/ontology/>
-    PREFIX yago:<http://dbpedia.org/class/yago/>
+        Instead of ORDER BY ... OFFSET, which makes the endpoint sort and skip
+        everything before every page, every page starts where the previous one
+        ended (keyset pagination on the entity URI). The URIs are split into
+        the ranges between the given partition boundaries, max_workers
+        partitions are fetched in parallel and every partition keeps at most
+        prefetch pages waiting, so the rows are yielded in URI order while
+        the following partitions are downloaded.
 
-    SELECT ?country_name ?population
-    WHERE {
-        ?country_name a dbo:Country .
-        ?country_name a yago:WikicatCountries .
-        
-        ?country_name dbpedia2:populationEstimate ?population . 
-    }
+        The arguments are
+        where : The graph pattern, it has to bind ?entity and ?value
+        page_size : The number of rows of one query
+        partitions : The sorted boundaries which split the URIs into ranges
+        max_workers : The number of partitions fetched at the same time
+        prefetch : The number of pages buffered for every partition
+        format : The result format requested from the endpoint, 'json', \
+                    'tsv' or 'csv' (which has no datatypes, but is the cheapest)
+        client : The SPARQLClient to use, by default the one of get_client()
+
+        It yields lists of (entity, value, datatype) tuples, the value being
+        the lexical form of the literal and the datatype its URI or None.
     """
-    sparql.setQuery(country_pops)  # the previous query as a literal string
-
-    results = sparql.query().convert()
-    spo_triples = results['results']['bindings']
-    ordered_pop = []
-    ordered_name = []
-    parsing_error = {}
-    for each in spo_triples:
-        try:
-            country_name = each['country_name']['value']
-            pop = int(each['population']['value'])
-            ordered_name.append(country_name)
-            ordered_pop.append(pop)
-        except Exception as e:
-            parsing_error[country_name] = each['population']['value']
-            pass
+    if client is None:
+        client = get_client()
+    bounds = [None] + list(partitions) + [None]
+    queues = [Queue(maxsize = prefetch) for i in range(len(bounds) - 1)]
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers = max_workers)
+    try:
+        for i, pages in enumerate(queues):
+            executor.submit(_fetch_partition, where, bounds[i], bounds[i + 1], \
+                                        page_size, client, format, pages, stop)
+        for pages in queues:
+            while True:
+                page = pages.get()
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+    finally:
+        stop.set()
+        executor.shutdown(wait = False)
+
+def iter_property_values(where, **options):
+    """The rows of iter_property_pages one (entity, value, datatype) tuple at a time"""
+    for page in iter_property_pages(where, **options):
+        for each in page:
+            yield each
+
+@instrumentation.traced('fetch')
+def get_population(where, parsing_exception_file, parsing_error = None, **options):
+    """This function fetches the population of the entities matched by the graph
+    pattern where (see iter_property_pages), parses the values as numbers and
+    writes the values which could not be parsed to parsing_exception_file
+    (if it is not None). They are also added to the parsing_error dictionary,
+    if one is given.
+
+    Every page is parsed in one pass by columns.parse_literals, which reads
+    integers, decimals and doubles of any numeric datatype. The rows are
+    streamed into a columns.ColumnBuilder, so it returns the populations as
+    a float64 numpy array and the entity URIs as a columns.StringTable,
+    which can be indexed like the list of URIs."""
+    columns = ColumnBuilder()
+    if parsing_error is None:
+        parsing_error = {}
+    failures = 0
+    for page in iter_property_pages(where, **options):
+        names, lexical, datatypes = zip(*page) if page else ((), (), ())
+        values, errors = parse_literals(lexical, datatypes)
+        ok = errors == PARSE_OK
+        columns.extend([name for name, each in zip(names, ok) if each], values[ok])
+        for i in np.flatnonzero(~ok):
+            parsing_error[names[i]] = lexical[i]
+        failures += int((~ok).sum())
+    ordered_pop, ordered_name = columns.build()
+    instrumentation.count('rows_parsed', len(columns))
+    instrumentation.count('parse_failures', failures)
 
     #Writing all the values which were not parsed properly to a file    
-    if len(parsing_error)!=0:
+    if len(parsing_error)!=0 and parsing_exception_file is not None:
         f = open(parsing_exception_file, "w")
         for each in parsing_error:
             f.write(each + ":" + parsing_error[each] + "\n")
         f.close()
-        
-        
     return (ordered_pop, ordered_name)
 
+def get_property_values(class_name, property_name, parsing_exception_file = None, **options):
+    """This function fetches the values of any property for the entities of a
+    class, e.g. get_property_values('dbo:Company', 'dbo:numberOfEmployees').
+    Prefixed names of PREFIXES or full URIs in angle brackets can be used.
+    The rest is the same as get_population."""
+    return get_population("""
+        ?entity a %s .
+        ?entity %s ?value .
+    """ % (class_name, property_name), parsing_exception_file, **options)
 
+def get_company_population(parsing_exception_file, **options):
+    return get_population("""
+        ?entity a dbo:Company .
+        ?entity dbo:numberOfEmployees ?value .
+    """, parsing_exception_file, **options)
 
-def get_city_population(parsing_exception_file):
-    sparql = SPARQLWrapper("http://dbpedia.org/sparql")
-    sparql.setReturnFormat(JSON)
 
 
-    city_pops = """
+def get_types(entity_URI):
+    query ="""
     PREFIX owl: <http://www.w3.org/2002/07/owl#>
     PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
     PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
@@ -187,37 +218,108 @@ def get_city_population(parsing_exception_file):
     PREFIX dbo: <http://dbpedia.org/ontology/>
     PREFIX yago:<http://dbpedia.org/class/yago/>
 
-    SELECT ?city_name ?enName ?population
+    SELECT DISTINCT ?concept
     WHERE {
-        ?city_name a dbo:City .
-        OPTIONAL { ?city_name dbo:populationTotal ?population . }
+        %s a ?concept .
     }
+    """ % (entity_URI)
+    return get_client().query(query)
+
+def get_types_batch(entity_URIs, batch_size = 50, max_workers = 4, client = None, skipped = None):
+    """This function gets the types of many entities with few queries.
+
+        The entities are packed batch_size at a time into the VALUES block of
+        a single query, and up to max_workers batches are fetched at once
+        over the keep-alive connections of one SPARQLClient. A batch whose
+        result reaches MAX_ROWS may have been truncated by the endpoint, so
+        it is split in two and fetched again, and the types of a single
+        entity with that many rows are fetched MAX_ROWS at a time.
+
+        The arguments are
+        entity_URIs : The URIs (without the angle brackets) of the entities
+        batch_size : The number of entities in one query
+        max_workers : The number of queries which run at the same time
+        client : The SPARQLClient to use, by default the one of get_client()
+        skipped : An optional list, the URIs which cannot be written in a \
+                    query are appended to it
+
+        It returns a dictionary with the list of types of every entity.
+        Entities whose URI cannot be written in a query get no types, a
+        warning gives their number.
     """
-    sparql.setQuery(city_pops)  # the previous query as a literal string
-
-    results = sparql.query().convert()
-    spo_triples = results['results']['bindings']
-    ordered_pop = []
-    ordered_name = []
-    parsing_error = {}
-    for each in spo_triples:
-        try:
-            city_name = each['city_name']['value']
-            pop = int(each['population']['value'])
-            ordered_name.append(city_name)
-            ordered_pop.append(pop)
-        except Exception as e:
-            parsing_error[country_name] = each['population']['value']
+    if client is None:
+        client = get_client()
+    entity_types = {}
+    valid = []
+    invalid = []
+    for each in entity_URIs:
+        if each in entity_types:
+            continue
+        entity_types[each] = []
+        if IRI_FORBIDDEN.isdisjoint(each):
+            valid.append(each)
+        else:
+            invalid.append(each)
+    if invalid:
+        warnings.warn("Skipping the types of %d entities whose URI cannot be written in a query" % \
+                                                                        len(invalid))
+        if skipped is not None:
+            skipped.extend(invalid)
 
+    def fetch_one(entity):
+        bindings = []
+        while True:
+            query = """
+            SELECT DISTINCT ?concept
+            WHERE {
+                <%s> a ?concept .
+            }
+            ORDER BY ?concept
+            LIMIT %d
+            OFFSET %d
+            """ % (entity, MAX_ROWS, len(bindings))
+            page = client.query(query)['results']['bindings']
+            bindings.extend({'entity' : {'type' : 'uri', 'value' : entity}, \
+                            'concept' : each['concept']} for each in page)
+            if len(page) < MAX_ROWS:
+                return bindings
 
+    def fetch(batch):
+        query = """
+        SELECT DISTINCT ?entity ?concept
+        WHERE {
+            VALUES ?entity { %s }
+            ?entity a ?concept .
+        }
+        """ % (" ".join("<" + each + ">" for each in batch))
+        bindings = client.query(query)['results']['bindings']
+        if len(bindings) >= MAX_ROWS:
+            if len(batch) == 1:
+                return fetch_one(batch[0])
+            middle = len(batch)//2
+            return fetch(batch[:middle]) + fetch(batch[middle:])
+        return bindings
 
-    #Writing all the values which were not parsed properly to a file    
-    if len(parsing_error)!=0:
-        f = open(parsing_exception_file, "w")
-        for each in parsing_error:
-            f.write(each + ":" + parsing_error[each] + "\n")
-        f.close() 
-    return (ordered_pop, ordered_name)
+    batches = [valid[i:i + batch_size] for i in range(0, len(valid), batch_size)]
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        for bindings in executor.map(fetch, batches):
+            for each in bindings:
+                entity_types.setdefault(each['entity']['value'], []).append(\
+                                                    each['concept']['value'])
+    return entity_types
+
+def get_country_population(parsing_exception_file, **options):
+    return get_population("""
+        ?entity a dbo:Country .
+        ?entity a yago:WikicatCountries .
+        ?entity dbpedia2:populationEstimate ?value .
+    """, parsing_exception_file, **options)
+
+def get_city_population(parsing_exception_file, **options):
+    return get_population("""
+        ?entity a dbo:City .
+        ?entity dbo:populationTotal ?value .
+    """, parsing_exception_file, **options)
 """
 if __name__=="__main__":
     Z = get_city_population()
@@ -0,0 +1,145 @@
+import numpy as np
+
+
+def sort_by_cluster(data, clusters):
+    """This function sorts the data once by cluster and by value.
+
+        The arguments are
+        data : The numpy array of values
+        clusters : The cluster label of every value (non negative integers)
+
+        It returns the following four things:
+        order : The permutation which sorts the data by (cluster, value)
+        sorted_data : data[order], so every cluster is a contiguous and \
+                                                sorted segment
+        starts : The position where the segment of every cluster starts
+        counts : The number of values in every cluster
+    """
+    data = np.asarray(data)
+    clusters = np.asarray(clusters)
+    order = np.lexsort((data, clusters))
+    counts = np.bincount(clusters)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return order, data[order], starts, counts
+
+def segment_ids(counts):
+    """Returns the segment (cluster) of every position of the sorted data"""
+    return np.repeat(np.arange(counts.size), counts)
+
+def _lerp(low, high, frac):
+    return np.where(frac >= 0.5, high - (high - low)*(1 - frac), low + (high - low)*frac)
+
+def segment_percentiles(sorted_data, starts, counts, q):
+    """This function computes a percentile of every segment of the sorted data.
+
+        It uses the same linear interpolation as np.percentile, without
+        looping over the segments. q can be a number or a sequence of
+        percentiles, in which case one row is returned per percentile.
+        Empty segments get nan.
+    """
+    q = np.asarray(q, dtype = float)
+    if sorted_data.size == 0:
+        return np.full(q.shape + counts.shape, np.nan)
+    size = np.maximum(counts, 1)
+    position = (size - 1)*(q[..., np.newaxis]/100.)
+    below = np.floor(position).astype(np.intp)
+    above = np.minimum(below + 1, size - 1)
+    last = sorted_data.size - 1
+    low = sorted_data[np.minimum(starts + below, last)]
+    high = sorted_data[np.minimum(starts + above, last)]
+    return np.where(counts > 0, _lerp(low, high, position - below), np.nan)
+
+def segment_medians(sorted_data, starts, counts):
+    """Returns the median of every segment of the sorted data (as np.median)"""
+    if sorted_data.size == 0:
+        return np.full(counts.shape, np.nan)
+    size = np.maximum(counts, 1)
+    last = sorted_data.size - 1
+    low = sorted_data[np.minimum(starts + (size - 1)//2, last)]
+    high = sorted_data[np.minimum(starts + size//2, last)]
+    return np.where(counts > 0, (low + high)/2., np.nan)
+
+def segment_searchsorted(sorted_data, starts, counts, targets):
+    """Returns for every segment the position of its first value which is not
+    smaller than the target of the segment (a vectorized binary search)."""
+    low = starts.copy()
+    high = starts + counts
+    last = max(sorted_data.size - 1, 0)
+    active = low < high
+    while active.any():
+        middle = (low + high)//2
+        right = active & (sorted_data[np.minimum(middle, last)] < targets)
+        low = np.where(right, middle + 1, low)
+        high = np.where(active & ~right, middle, high)
+        active = low < high
+    return low
+
+def _segment_kth_deviation(sorted_data, starts, counts, medians, split, k):
+    """Returns the k-th smallest (from 0) absolute deviation from the median
+    of every segment.
+
+        Left of split the deviations median - value grow towards the start of
+        the segment, right of it value - median grows towards the end, so
+        they are two sorted runs. The k-th smallest element of two sorted
+        runs is found with a binary search over how many of the k + 1
+        smallest deviations come from the left run.
+    """
+    last = max(sorted_data.size - 1, 0)
+    left = split - starts
+    right = counts - left
+    low = np.maximum(0, k + 1 - right)
+    high = np.minimum(left, k + 1)
+    active = low < high
+    while active.any():
+        middle = (low + high)//2
+        j = k + 1 - middle
+        from_right = sorted_data[np.clip(split + j - 1, 0, last)] - medians
+        from_left = medians - sorted_data[np.clip(split - 1 - middle, 0, last)]
+        more = active & (middle < left) & (j > 0) & (from_right > from_left)
+        low = np.where(more, middle + 1, low)
+        high = np.where(active & ~more, middle, high)
+        active = low < high
+    j = k + 1 - low
+    from_left = np.where(low > 0, medians - sorted_data[np.clip(split - low, 0, last)], -np.inf)
+    from_right = np.where(j > 0, sorted_data[np.clip(split + j - 1, 0, last)] - medians, -np.inf)
+    return np.maximum(from_left, from_right)
+
+def segment_mads(sorted_data, starts, counts, medians):
+    """This function computes the median absolute deviation of every segment
+    around the given per segment medians.
+
+        The deviations are never materialized or sorted: their median is
+        selected from the two sorted runs on either side of the median, in
+        O(log n) vectorized steps for all the segments together.
+    """
+    if sorted_data.size == 0:
+        return np.full(counts.shape, np.nan)
+    split = segment_searchsorted(sorted_data, starts, counts, medians)
+    size = np.maximum(counts, 1)
+    low = _segment_kth_deviation(sorted_data, starts, counts, medians, split, (size - 1)//2)
+    high = _segment_kth_deviation(sorted_data, starts, counts, medians, split, size//2)
+    return np.where(counts > 0, (low + high)/2., np.nan)
+
+def segment_extremes(sorted_data, starts, counts):
+    """Returns the minimum and the maximum of every segment"""
+    if sorted_data.size == 0:
+        return np.full(counts.shape, np.nan), np.full(counts.shape, np.nan)
+    last = sorted_data.size - 1
+    minimum = sorted_data[np.minimum(starts, last)]
+    maximum = sorted_data[np.clip(starts + counts - 1, 0, last)]
+    return np.where(counts > 0, minimum, np.nan), np.where(counts > 0, maximum, np.nan)
+
+def segment_mean_std(sorted_data, counts):
+    """Returns the mean and the (population) standard deviation of every segment"""
+    ids = segment_ids(counts)
+    size = np.maximum(counts, 1)
+    mean = np.bincount(ids, weights = sorted_data, minlength = counts.size)/size
+    var = np.bincount(ids, weights = (sorted_data - mean[ids])**2, minlength = counts.size)/size
+    return mean, np.sqrt(var)
+
+def scatter_flags(order, flags):
+    """This function maps flags computed on the sorted data back to the original
+    positions and returns the flagged indices in ascending order."""
+    mask = np.zeros(order.size, dtype = bool)
+    mask[order] = flags
+    return np.flatnonzero(mask)
@@ -0,0 +1,260 @@
+import numpy as np
+import grouped
+from columns import StringTable, string_hashes, check_hashes
+from snapshot import save_snapshot, load_snapshot
+
+INCREMENTAL_METHODS = ('IQR', 'MAD')
+
+
+def _same(a):
+    """Marks the entries of a sorted array which are equal to the previous one (nan equals nan)"""
+    if a.dtype.kind == 'f':
+        return (a[1:] == a[:-1]) | (np.isnan(a[1:]) & np.isnan(a[:-1]))
+    return a[1:] == a[:-1]
+
+def diff_rows(old_keys, old_values, old_clusters, new_keys, new_values, new_clusters):
+    """This function compares two versions of a dataset by URI.
+
+        A row is the triple (URI, value, cluster) and both versions are
+        treated as multisets of rows, so entities with several values are
+        handled, and a changed value (or cluster) is a deleted plus an
+        inserted row. The rows of both versions are sorted together once,
+        so the comparison is a vectorized merge.
+
+        It returns the indices of the deleted rows of the old version and of
+        the inserted rows of the new version.
+    """
+    size = old_values.size
+    keys = np.concatenate((old_keys, new_keys))
+    values = np.concatenate((old_values, new_values))
+    clusters = np.concatenate((old_clusters, new_clusters))
+    source = np.concatenate((np.zeros(size, dtype = np.intp), np.ones(new_values.size, dtype = np.intp)))
+    order = np.lexsort((source, values, clusters, keys))
+    if order.size == 0:
+        return np.zeros(0, dtype = np.intp), np.zeros(0, dtype = np.intp)
+    first = np.concatenate(([True], ~(_same(keys[order]) & _same(values[order]) & \
+                                                _same(clusters[order]))))
+    group = np.cumsum(first) - 1
+    position = np.arange(order.size) - np.flatnonzero(first)[group]
+    old = source[order] == 0
+    old_count = np.bincount(group, weights = old).astype(np.intp)[group]
+    new_count = np.bincount(group, weights = ~old).astype(np.intp)[group]
+    #The first min(old, new) copies of a row are matched
+    deleted = old & (position >= new_count)
+    inserted = ~old & (position - old_count >= old_count)
+    return np.sort(order[deleted]), np.sort(order[inserted] - size)
+
+
+def _iqr_rule(values, starts, counts, upper = 75, lower = 25, iqrFactor = 1.5, **unused):
+    if lower>upper:
+        lower, upper = upper, lower
+    qUpper, qLower = grouped.segment_percentiles(values, starts, counts, [upper,lower])
+    iqrFactored = iqrFactor*(qUpper-qLower)
+    low, high = qLower-iqrFactored, qUpper+iqrFactored
+    return (qUpper+qLower)/2., lambda v, i: (v<low[i]) | (v>high[i])
+
+def _mad_rule(values, starts, counts, madFactor = 1, **unused):
+    median = grouped.segment_medians(values, starts, counts)
+    threshold = madFactor*grouped.segment_mads(values, starts, counts, median)
+    return median, lambda v, i: np.abs(v-median[i])>=threshold[i]
+
+_RULES = {
+    'IQR' : _iqr_rule,
+    'MAD' : _mad_rule,
+}
+
+def _first(values, low, high, test):
+    """The first position in [low, high) where test holds, test being monotone"""
+    while low < high:
+        middle = (low + high)//2
+        if test(values[middle:middle + 1])[0]:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+def _flagged_ranges(values, start, stop, center, flag, i):
+    """Every rule flags a prefix and a suffix of a sorted cluster, this returns
+    the end of the prefix and the start of the suffix."""
+    middle = start + np.searchsorted(values[start:stop], center, side = 'left')
+    prefix = _first(values, start, middle, lambda v: ~flag(v, i))
+    suffix = _first(values, middle, stop, lambda v: flag(v, i))
+    return prefix, suffix
+
+
+class IncrementalDetector(object):
+    """The IQR and MAD detectors of main.py for datasets which are refreshed.
+
+        The state keeps every row sorted by (cluster, value), with its URI in
+        a columns.StringTable and a 64-bit hash of the URI as its key (see
+        columns.string_hashes). update() compares a new
+        version of the dataset with the state (diff_rows) and then only
+        works on the changed rows:
+        - the deleted and inserted rows are located with binary searches,
+        - the percentiles, median and MAD of a changed cluster are read from
+          the sorted values in O(log n) (grouped.segment_mads),
+        - a rule flags a prefix and a suffix of a sorted cluster, so only the
+          points between the old and the new cut positions are re-scored.
+        Apart from the diff itself and moving the arrays in memory when rows
+        are deleted and inserted (np.delete and np.insert), the cost of an
+        update is proportional to the number of changed rows.
+
+        The arguments are
+        values, uris, clusters : The dataset (clusters is None without \
+                    preprocessing, i.e. a single cluster)
+        methods : The detectors, a subset of INCREMENTAL_METHODS
+        parameters : upper, lower and iqrFactor of find_outliers_using_IQR \
+                    and madFactor (the multiplyingFactor of find_outliers_using_MAD)
+
+        The outliers are always the ones find_outliers_using_IQR and
+        find_outliers_using_MAD (with preprocess = True when there are
+        clusters) find on the current version of the dataset.
+    """
+
+    def __init__(self, values, uris, clusters = None, methods = INCREMENTAL_METHODS, \
+                                                    _sorted = False, **parameters):
+        for method in methods:
+            if method not in _RULES:
+                raise ValueError("Unknown incremental method %r, expected one of %s" % \
+                                    (method, ", ".join(INCREMENTAL_METHODS)))
+        values = np.asarray(values, dtype = float)
+        if not isinstance(uris, StringTable):
+            uris = StringTable.from_strings(uris)
+        keys = string_hashes(uris)
+        check_hashes(uris, keys)
+        clusters = np.zeros(values.size, dtype = np.intp) if clusters is None \
+                                    else np.asarray(clusters, dtype = np.intp)
+        if not _sorted:
+            order = np.lexsort((values, clusters))
+            values, keys, clusters, uris = values[order], keys[order], clusters[order], uris.take(order)
+        self.values = np.array(values)
+        self.keys = np.array(keys)
+        self.uris = uris
+        self.clusters = np.array(clusters)
+        self.methods = tuple(methods)
+        self.parameters = parameters
+        self.counts = np.bincount(self.clusters)
+        self._set_starts()
+
+    def _set_starts(self):
+        self.starts = np.concatenate(([0], np.cumsum(self.counts)[:-1])).astype(np.intp)
+
+    def __len__(self):
+        return self.values.size
+
+    def _rules(self, clusters):
+        starts, counts = self.starts[clusters], self.counts[clusters]
+        return dict((method, _RULES[method](self.values, starts, counts, **self.parameters)) \
+                                                            for method in self.methods)
+
+    def _cuts(self, rules, clusters):
+        return dict((method, [_flagged_ranges(self.values, self.starts[c], \
+                        self.starts[c] + self.counts[c], center[i], flag, i) \
+                        for i, c in enumerate(clusters)]) \
+                                    for method, (center, flag) in rules.items())
+
+    def outliers(self, method):
+        """Returns the URIs (list) and the values of the current outliers of a method"""
+        clusters = np.flatnonzero(self.counts)
+        cuts = self._cuts({method : self._rules(clusters)[method]}, clusters)[method]
+        positions = np.concatenate([np.zeros(0, dtype = np.intp)] + \
+                        [np.r_[self.starts[c]:prefix, suffix:self.starts[c] + self.counts[c]] \
+                        for c, (prefix, suffix) in zip(clusters, cuts)]).astype(np.intp)
+        return self.uris.take(positions).tolist(), self.values[positions]
+
+    def update(self, values, uris, clusters = None):
+        """This function replaces the dataset by a new version.
+
+            The arguments are the ones of the constructor.
+
+            It returns a dictionary of method : (added, removed), the lists
+            of (URI, value) pairs which became and which are no longer
+            outliers. Deleted rows which were outliers are removed, inserted
+            rows which are outliers are added.
+        """
+        values = np.asarray(values, dtype = float)
+        if not isinstance(uris, StringTable):
+            uris = StringTable.from_strings(uris)
+        keys = string_hashes(uris)
+        check_hashes(self.uris.concatenate(uris), np.concatenate((self.keys, keys)))
+        clusters = np.zeros(values.size, dtype = np.intp) if clusters is None \
+                                    else np.asarray(clusters, dtype = np.intp)
+        deleted, inserted = diff_rows(self.keys, self.values, self.clusters, keys, values, clusters)
+        return self._apply(deleted, keys[inserted], uris.take(inserted), values[inserted], \
+                                                                clusters[inserted])
+
+    def _apply(self, deleted, keys, uris, values, clusters):
+        changes = dict((method, ([], [])) for method in self.methods)
+        if deleted.size == 0 and values.size == 0:
+            return changes
+        size = max(self.counts.size, clusters.max() + 1 if clusters.size else 0)
+        if size > self.counts.size:
+            self.counts = np.concatenate((self.counts, np.zeros(size - self.counts.size, dtype = self.counts.dtype)))
+            self._set_starts()
+        affected = np.union1d(self.clusters[deleted], clusters).astype(np.intp)
+        index = np.zeros(size, dtype = np.intp)
+        index[affected] = np.arange(affected.size)
+
+        #Deleted outliers are removed with the rules of the old version
+        old_rules = self._rules(affected)
+        for method, (center, flag) in old_rules.items():
+            gone = deleted[flag(self.values[deleted], index[self.clusters[deleted]])]
+            changes[method][1].extend(zip(self.uris.take(gone).tolist(), self.values[gone].tolist()))
+
+        self.counts = self.counts - np.bincount(self.clusters[deleted], minlength = size)
+        self.values = np.delete(self.values, deleted)
+        self.keys = np.delete(self.keys, deleted)
+        self.uris = StringTable(self.uris.data, self.uris.offsets, np.delete(self.uris.codes, deleted))
+        self.clusters = np.delete(self.clusters, deleted)
+        self._set_starts()
+
+        order = np.lexsort((values, clusters))
+        keys, values, clusters, uris = keys[order], values[order], clusters[order], uris.take(order)
+        positions = grouped.segment_searchsorted(self.values, self.starts[clusters], \
+                                                    self.counts[clusters], values)
+        self.values = np.insert(self.values, positions, values)
+        self.keys = np.insert(self.keys, positions, keys)
+        table = self.uris.concatenate(uris)
+        self.uris = StringTable(table.data, table.offsets, \
+                    np.insert(table.codes[:len(self.uris)], positions, table.codes[len(self.uris):]))
+        #The strings of deleted rows stay in the buffer until it is compacted
+        if self.uris.offsets.size > 2*len(self.uris) + 1:
+            self.uris = self.uris.compact()
+        self.clusters = np.insert(self.clusters, positions, clusters)
+        self.counts = self.counts + np.bincount(clusters, minlength = size)
+        self._set_starts()
+        fresh = positions + np.arange(positions.size)
+
+        new_rules = self._rules(affected)
+        old_cuts = self._cuts(old_rules, affected)
+        new_cuts = self._cuts(new_rules, affected)
+        for method in self.methods:
+            old_flag, new_flag = old_rules[method][1], new_rules[method][1]
+            added, removed = changes[method]
+            for i, c in enumerate(affected):
+                (old_prefix, old_suffix), (new_prefix, new_suffix) = old_cuts[method][i], new_cuts[method][i]
+                candidates = np.unique(np.r_[min(old_prefix, new_prefix):max(old_prefix, new_prefix), \
+                                min(old_suffix, new_suffix):max(old_suffix, new_suffix)]).astype(np.intp)
+                #Only the rows which were already there can change their status
+                at = np.minimum(np.searchsorted(fresh, candidates), max(fresh.size - 1, 0))
+                if fresh.size:
+                    candidates = candidates[fresh[at] != candidates]
+                was, now = old_flag(self.values[candidates], i), new_flag(self.values[candidates], i)
+                for rows, target in ((candidates[now & ~was], added), (candidates[was & ~now], removed)):
+                    target.extend(zip(self.uris.take(rows).tolist(), self.values[rows].tolist()))
+            rows = fresh[new_flag(self.values[fresh], index[self.clusters[fresh]])]
+            added.extend(zip(self.uris.take(rows).tolist(), self.values[rows].tolist()))
+        return changes
+
+    def save(self, path):
+        """Saves the state as a snapshot (see snapshot.save_snapshot), sorted by cluster and value"""
+        save_snapshot(path, self.values, self.uris.compact(), self.clusters, \
+                    incremental = {'methods' : list(self.methods), 'parameters' : self.parameters})
+
+    @classmethod
+    def load(cls, path):
+        """Opens a state saved by save"""
+        snapshot = load_snapshot(path)
+        state = snapshot.manifest['metadata']['incremental']
+        return cls(snapshot.values, snapshot.uris, snapshot.clusters, state['methods'], \
+                                                    _sorted = True, **state['parameters'])
@@ -0,0 +1,280 @@
+import atexit
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+
+#OUTLIER_METRICS=jsonl:metrics.jsonl,prometheus:metrics.prom enables the sinks at import
+ENVIRONMENT_VARIABLE = "OUTLIER_METRICS"
+PROMETHEUS_PREFIX = "outlier_detection_"
+
+_sinks = []
+_local = threading.local()
+_main_thread = threading.main_thread()
+
+
+def _read_status(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1])*1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _peak_rss():
+    peak = _read_status("VmHWM:")
+    if peak is None:
+        import resource
+        #kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak *= 1 if os.uname().sysname == 'Darwin' else 1024
+    return peak
+
+def _reset_peak_rss():
+    """Resets the peak RSS of the process (Linux 4.0 and later), so the peak of
+    a span is its own and not the one of the whole run"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.peak = 0
+
+    def __enter__(self):
+        self.stack = getattr(_local, 'stack', None)
+        if self.stack is None:
+            self.stack = _local.stack = []
+        self.parent = self.stack[-1] if self.stack else None
+        #The peak RSS is reset per span on the main thread only, worker
+        #threads report the peak of the process
+        self.own_peak = threading.current_thread() is _main_thread
+        if self.own_peak:
+            if self.parent is not None:
+                self.parent.peak = max(self.parent.peak, _peak_rss())
+            self.own_peak = _reset_peak_rss()
+        self.stack.append(self)
+        self.start = time.time()
+        self._clock = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        seconds = time.perf_counter() - self._clock
+        self.stack.pop()
+        self.peak = max(self.peak, _peak_rss())
+        if self.own_peak and self.parent is not None:
+            self.parent.peak = max(self.parent.peak, self.peak)
+        event = {
+            'type' : 'span',
+            'name' : self.name,
+            'labels' : self.labels,
+            'parent' : self.parent.name if self.parent is not None else None,
+            'start' : self.start,
+            'seconds' : seconds,
+            'peak_rss' : self.peak,
+            'error' : exc_type.__name__ if exc_type is not None else None,
+            'pid' : os.getpid(),
+        }
+        for sink in _sinks:
+            sink.span(event)
+        return False
+
+
+def enabled():
+    return bool(_sinks)
+
+def span(name, **labels):
+    """Returns a context manager which measures the wall-clock time and the peak
+    RSS of a stage of the pipeline, e.g.
+
+        with instrumentation.span('kde', method = 'binned'):
+            ...
+
+    Spans can be nested. Without a sink it is a shared object which does nothing."""
+    if not _sinks:
+        return _NULL_SPAN
+    return _Span(name, labels)
+
+def count(name, value = 1, **labels):
+    """Adds value to the counter name (e.g. 'queries_issued'), a no-op without a sink"""
+    if not _sinks:
+        return
+    for sink in _sinks:
+        sink.count(name, value, labels)
+
+def traced(name, points = None):
+    """A decorator which runs the function in a span. If points is the name of a
+    counter, the length of the first argument is added to it."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return function(*args, **kwargs)
+            if points is not None and args:
+                count(points, len(args[0]))
+            with _Span(name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _Totals(object):
+    """Keeps the counters and the span totals of a sink"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.spans = defaultdict(lambda: [0, 0.0, 0])
+
+    def count(self, name, value, labels):
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def span(self, event):
+        with self._lock:
+            total = self.spans[(event['name'], tuple(sorted(event['labels'].items())))]
+            total[0] += 1
+            total[1] += event['seconds']
+            total[2] = max(total[2], event['peak_rss'] or 0)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.spans.clear()
+
+
+class JSONLinesSink(_Totals):
+    """Appends one JSON object per line to a file: one per finished span and,
+    when the sink is closed, one per counter. Lines are written with a single
+    append each, so several processes can share the file. Forked worker
+    processes (e.g. of batch.run_batch) write their counters after every
+    span, the counter lines of all the processes add up to the totals."""
+
+    def __init__(self, path):
+        _Totals.__init__(self)
+        self.path = path
+        self._file = open(path, "a")
+        self._pid = os.getpid()
+
+    def _write(self, event):
+        self._file.write(json.dumps(event) + "\n")
+        self._file.flush()
+
+    def span(self, event):
+        self._write(event)
+        if os.getpid() != self._pid:
+            self._write_counters()
+
+    def _write_counters(self):
+        with self._lock:
+            counters = sorted(self.counters.items())
+            self.counters.clear()
+        for (name, labels), value in counters:
+            self._write({'type' : 'counter', 'name' : name, 'labels' : dict(labels), \
+                                    'value' : value, 'pid' : os.getpid()})
+
+    def close(self):
+        self._write_counters()
+        self._file.close()
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) \
+                                                    for key, value in labels)
+
+class PrometheusSink(_Totals):
+    """Writes the totals in the Prometheus text format (e.g. for the textfile
+    collector of the node exporter) when it is closed or flushed: the number
+    of calls, the total seconds and the peak RSS of every span and the value
+    of every counter. The file is replaced atomically. Only the process
+    which created the sink writes it, so the counters of worker processes
+    are only in a JSONLinesSink."""
+
+    def __init__(self, path):
+        _Totals.__init__(self)
+        self.path = path
+        self._pid = os.getpid()
+
+    def flush(self):
+        lines = []
+        with self._lock:
+            for metric, kind, index in (('span_calls_total', 'counter', 0), \
+                        ('span_seconds_total', 'counter', 1), ('span_peak_rss_bytes', 'gauge', 2)):
+                lines.append("# TYPE %s%s %s" % (PROMETHEUS_PREFIX, metric, kind))
+                for (name, labels), total in sorted(self.spans.items()):
+                    lines.append("%s%s%s %r" % (PROMETHEUS_PREFIX, metric, \
+                                _prometheus_labels((('span', name),) + labels), total[index]))
+            for name in sorted(set(name for name, _ in self.counters)):
+                lines.append("# TYPE %s%s_total counter" % (PROMETHEUS_PREFIX, name))
+                for (other, labels), value in sorted(self.counters.items()):
+                    if other == name:
+                        lines.append("%s%s_total%s %r" % (PROMETHEUS_PREFIX, name, \
+                                                    _prometheus_labels(labels), value))
+        temporary = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(temporary, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.rename(temporary, self.path)
+
+    def close(self):
+        #Forked workers share the sink object but only the owner writes the file
+        if os.getpid() == self._pid:
+            self.flush()
+
+
+SINKS = {
+    'jsonl' : JSONLinesSink,
+    'prometheus' : PrometheusSink,
+}
+
+def add_sink(sink):
+    """Starts sending the spans and counters to sink, the sinks are closed at exit"""
+    _sinks.append(sink)
+    return sink
+
+def close():
+    """Closes and removes all the sinks, which disables the instrumentation"""
+    while _sinks:
+        _sinks.pop().close()
+
+def configure(specification):
+    """Adds the sinks of a specification such as "jsonl:metrics.jsonl,prometheus:metrics.prom" """
+    for each in specification.split(","):
+        if not each.strip():
+            continue
+        kind, _, path = each.strip().partition(":")
+        if kind not in SINKS or not path:
+            raise ValueError("Unknown metrics sink %r, expected kind:path with kind one of %s" % \
+                                                    (each, ", ".join(sorted(SINKS))))
+        add_sink(SINKS[kind](path))
+
+def _after_fork():
+    for sink in _sinks:
+        sink.reset()
+
+atexit.register(close)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child = _after_fork)
+if os.environ.get(ENVIRONMENT_VARIABLE):
+    configure(os.environ[ENVIRONMENT_VARIABLE])
@@ -0,0 +1,223 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from sklearn.neighbors import KernelDensity
+
+KDE_METHODS = ('exact', 'binned', 'tree', 'window', 'chunked')
+
+#The number of kernel values density_chunked evaluates at once per thread
+KERNEL_BLOCK = 1 << 18
+
+
+def gauss(x, mu, sigma):
+    return (1/sigma*(np.sqrt(2*np.pi)))*np.exp((-1/(2*sigma*sigma))*((x-mu)**2))
+
+def bandwidth(sigma, n):
+    """The rule of thumb bandwidth used by main.KDE when h is not given"""
+    return (((4*(sigma**5))/(3*n))**0.2)
+
+def density_exact(x, h, mu, sigma, block_size = None):
+    """This function evaluates the density of every point of x exactly.
+
+        Instead of looping over the points in Python, the queries are
+        evaluated block_size at a time against the whole array, so at most
+        block_size * n kernel values are held in memory at once.
+        The result is identical to the original loop in main.KDE.
+    """
+    n = x.size
+    if block_size is None:
+        block_size = max(1, (1 << 22)//max(n, 1))
+    fnh = np.empty(n)
+    for start in range(0, n, block_size):
+        queries = x[start:start + block_size]
+        fnh[start:start + queries.size] = np.sum(gauss((x[np.newaxis, :] - \
+                    queries[:, np.newaxis])/h, mu, sigma), axis = 1)
+    return fnh/(n*h)
+
+def density_binned(x, h, mu, sigma, grid_size = None):
+    """This function evaluates the density using linear binning and an FFT convolution.
+
+        The points are spread over grid_size equally spaced grid points
+        (spacing delta) with linear binning, the binned counts are convolved
+        with the kernel sampled at the grid offsets, and the density of every
+        point is linearly interpolated back from the grid. The cost is
+        O(n + grid_size log grid_size).
+
+        The kernel of main.KDE is a Gaussian of width b = sigma*h in the units
+        of x, so binning and interpolation each move a kernel value by at most
+        delta**2/8 * max|K''| = delta**2/8 * A/b**2 with A = sqrt(2*pi)/sigma.
+        The absolute error of every density is therefore bounded by
+            A * delta**2 / (4 * h * b**2)
+        By default the grid is chosen so that delta <= b/4 (at most 2**20
+        points), pass a larger grid_size to tighten the bound.
+    """
+    n = x.size
+    lo, hi = x.min(), x.max()
+    if hi == lo:
+        return np.full(n, gauss(0.0, mu, sigma)/h)
+    if grid_size is None:
+        grid_size = int(min(1 << 20, max(1 << 10, np.ceil(4*(hi - lo)/(sigma*h)) + 1)))
+    delta = (hi - lo)/(grid_size - 1)
+
+    position = (x - lo)/delta
+    left = np.minimum(position.astype(np.intp), grid_size - 2)
+    frac = position - left
+    counts = np.bincount(left, weights = 1 - frac, minlength = grid_size) + \
+                np.bincount(left + 1, weights = frac, minlength = grid_size)
+
+    #kernel[t + grid_size - 1] is the kernel for a point t grid steps below the query
+    offsets = np.arange(grid_size - 1, -grid_size, -1)*delta
+    kernel = gauss(offsets/h, mu, sigma)
+    size = 1 << int(np.ceil(np.log2(3*grid_size - 2)))
+    grid = np.fft.irfft(np.fft.rfft(counts, size)*np.fft.rfft(kernel, size), size)
+    grid = np.maximum(grid[grid_size - 1:2*grid_size - 1], 0)
+
+    fnh = (1 - frac)*grid[left] + frac*grid[left + 1]
+    return fnh/(n*h)
+
+def density_tree(x, h, mu, sigma, tolerance = 1e-8):
+    """This function evaluates the density with a KD-tree (scikit-learn KernelDensity).
+
+        The kernel of main.KDE is a Gaussian of width sigma*h centred at
+        x[i] + mu*h, so the tree is queried at the shifted points. Nodes of the
+        tree are pruned once their contribution is known to the relative
+        tolerance, so every density is within tolerance * density of the
+        exact value.
+    """
+    b = sigma*h
+    tree = KernelDensity(kernel = 'gaussian', bandwidth = b, algorithm = 'kd_tree', \
+                rtol = tolerance).fit(x[:, np.newaxis])
+    log_density = tree.score_samples((x + mu*h)[:, np.newaxis])
+    return np.exp(log_density)*b*np.sqrt(2*np.pi)*gauss(mu, mu, sigma)/h
+
+def density_window(x, h, mu, sigma, cutoff = 8, block_size = 1024, memory_limit = 256*1024**2):
+    """This function evaluates the density of the data with a neighbour window.
+
+        The kernel of main.KDE is a Gaussian of width b = sigma*h centred at
+        x[i] + mu*h. On the sorted data the points within cutoff*b of that
+        centre are a contiguous window found with np.searchsorted, and a
+        block of block_size consecutive queries only needs the union of
+        their windows. Every kernel value left out is below
+        A*exp(-cutoff**2/2) (A = sqrt(2*pi)/sigma), so the absolute error
+        of every density is at most A*exp(-cutoff**2/2)/h, about 1e-14*A/h
+        for the default cutoff. The work is proportional to the number of
+        neighbours in the windows, so it is fast when the kernel is narrow
+        compared to the spread of the data. A window wider than fits in
+        memory_limit bytes of kernel values (gauss needs a few temporaries of
+        the same size) is summed in several pieces, so a wide kernel costs
+        time but not memory.
+
+        Unsorted data is sorted first and the densities are returned in the
+        order of x.
+    """
+    n = x.size
+    order = None
+    if np.any(x[1:] < x[:-1]):
+        order = np.argsort(x, kind = 'mergesort')
+        x = x[order]
+    b = sigma*h
+    first = np.searchsorted(x, x + mu*h - cutoff*b, side = 'left')
+    last = np.searchsorted(x, x + mu*h + cutoff*b, side = 'right')
+    fnh = np.zeros(n)
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        low, high = first[start], last[stop - 1]
+        width = max(memory_limit//(4*8*(stop - start)), 1)
+        for piece in range(low, high, width):
+            fnh[start:stop] += np.sum(gauss((x[np.newaxis, piece:min(piece + width, high)] - \
+                        x[start:stop, np.newaxis])/h, mu, sigma), axis = 1)
+    if order is not None:
+        fnh[order] = fnh.copy()
+    return fnh/(n*h)
+
+def density_chunked(x, h, mu, sigma, cutoff = None, memory_limit = 256*1024**2, n_jobs = None):
+    """This function evaluates the exact density in blocks under a memory cap.
+
+        The data is sorted once, the queries are split into blocks and every
+        block is summed against the reference points in chunks of at most
+        KERNEL_BLOCK kernel values per thread, and never more than
+        memory_limit bytes of kernel values at any time, whatever the size
+        of x. The blocks are spread over n_jobs threads (by default
+        one per CPU), NumPy releases the GIL in the arithmetic and in exp.
+
+        Without a cutoff every pair is evaluated, the result is the one of
+        density_exact up to rounding. With a cutoff only the points within
+        cutoff*sigma*h of the kernel centre (the kernel width is sigma*h,
+        see density_window) are summed, found by a binary search on the
+        sorted data, and the absolute error of every density is at most
+        A*exp(-cutoff**2/2)/h (A = sqrt(2*pi)/sigma).
+    """
+    n = x.size
+    order = None
+    if np.any(x[1:] < x[:-1]):
+        order = np.argsort(x, kind = 'mergesort')
+        x = x[order]
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    #Blocks of about 2 MB stay in the cache of a core, which is faster than
+    #using the whole memory budget at once
+    elements = max(min(memory_limit//(8*n_jobs), KERNEL_BLOCK), 64)
+    query_size = 64
+    reference_size = elements//query_size
+    if cutoff is not None:
+        b = sigma*h
+        first = np.searchsorted(x, x + mu*h - cutoff*b, side = 'left')
+        last = np.searchsorted(x, x + mu*h + cutoff*b, side = 'right')
+    fnh = np.empty(n)
+
+    def evaluate(start):
+        stop = min(start + query_size, n)
+        #gauss((x[j] - x[i])/h, mu, sigma) is proportional to
+        #exp(-((x[j] - x[i] - mu*h)/(sigma*h*sqrt(2)))**2), computed in place
+        centres = x[start:stop, np.newaxis] + mu*h
+        scale = 1/(sigma*h*np.sqrt(2))
+        low, high = (first[start], last[stop - 1]) if cutoff is not None else (0, n)
+        total = np.zeros(stop - start)
+        for reference in range(low, high, reference_size):
+            kernel = x[np.newaxis, reference:min(reference + reference_size, high)] - centres
+            kernel *= scale
+            np.square(kernel, out = kernel)
+            np.negative(kernel, out = kernel)
+            np.exp(kernel, out = kernel)
+            total += kernel.sum(axis = 1)
+        fnh[start:stop] = total*gauss(mu, mu, sigma)
+
+    with ThreadPoolExecutor(max_workers = n_jobs) as executor:
+        list(executor.map(evaluate, range(0, n, query_size)))
+    if order is not None:
+        fnh[order] = fnh.copy()
+    return fnh/(n*h)
+
+_BACKENDS = {
+    'exact' : density_exact,
+    'binned' : density_binned,
+    'tree' : density_tree,
+    'window' : density_window,
+    'chunked' : density_chunked,
+}
+
+def kde_density(x, h, mu, sigma, method = 'exact', **options):
+    """This function returns the (unnormalized) density fnh of main.KDE for every point.
+
+        The arguments are
+        x : The numpy array of values
+        h : The bandwidth
+        mu, sigma : The mean and standard deviation used by the kernel
+        method : 'exact' (vectorized in blocks), 'binned' (linear binning and
+                    FFT), 'tree' (KD-tree with a relative tolerance),
+                    'window' (neighbour windows on the sorted data) or
+                    'chunked' (exact or cut off, in blocks under a memory
+                    cap on a thread pool)
+        options : Passed on to the backend (block_size, grid_size, tolerance,
+                    cutoff, memory_limit or n_jobs)
+
+        A point is only classified differently from the exact method when its
+        normalized density is within the backend's error bound of the threshold.
+    """
+    if method not in _BACKENDS:
+        raise ValueError("Unknown KDE method %r, expected one of %s" % \
+                                    (method, ", ".join(KDE_METHODS)))
+    x = np.asarray(x, dtype = float)
+    if sigma == 0 or h == 0:
+        return np.full(x.size, np.nan)
+    return _BACKENDS[method](x, h, mu, sigma, **options)
@@ -0,0 +1,101 @@
+import numpy as np
+
+KNN_SCORES = ('lof', 'knn')
+
+#Added to the mean reachability distance, so duplicated values get a finite
+#local reachability density (as in scikit-learn)
+EPSILON = 1e-10
+
+
+def knn_windows(sorted_x, k):
+    """This function finds the k nearest neighbours of every point of a sorted array.
+
+        On a line the k nearest neighbours of a point are, together with the
+        point, k + 1 consecutive values of the sorted array, so only the k + 1
+        windows [j, j + k] with i - k <= j <= i have to be compared: the
+        k-distance of point i is the smallest max(x[i] - x[j], x[j + k] - x[i])
+        over them. This is k + 1 vectorized passes over the array, O(n k)
+        after the O(n log n) sort and without a tree.
+
+        It returns the k-distance of every point and the start j of its
+        neighbour window. sorted_x needs more than k values.
+    """
+    n = sorted_x.size
+    positions = np.arange(n)
+    k_distance = np.full(n, np.inf)
+    start = np.zeros(n, dtype = np.intp)
+    for shift in range(k + 1):
+        j = positions[shift:min(n, n - k + shift)] - shift
+        points = slice(shift, j.size + shift)
+        candidate = np.maximum(sorted_x[points] - sorted_x[j], sorted_x[j + k] - sorted_x[points])
+        better = candidate < k_distance[points]
+        k_distance[points] = np.where(better, candidate, k_distance[points])
+        start[points] = np.where(better, j, start[points])
+    return k_distance, start
+
+def _neighbours(start, k):
+    """Yields the b-th point of the neighbour window of every point, b = 0 ... k,
+    and the mask of the points for which it is not the point itself"""
+    positions = np.arange(start.size)
+    for b in range(k + 1):
+        neighbour = start + b
+        yield neighbour, neighbour != positions
+
+def lof_scores(sorted_x, k = 20):
+    """This function returns the Local Outlier Factor of every point of a sorted array.
+
+        The local reachability density of a point is the inverse of the mean
+        reachability distance max(k-distance(o), |x - o|) to its k nearest
+        neighbours o, and the LOF is the mean density of the neighbours over
+        the density of the point: about 1 inside a cluster of values, larger
+        for isolated values. The neighbours come from knn_windows, so the
+        cost is O(n k). Arrays of at most k values use k = n - 1.
+    """
+    n = sorted_x.size
+    k = min(k, n - 1)
+    if k < 1:
+        return np.ones(n)
+    k_distance, start = knn_windows(sorted_x, k)
+    reach = np.zeros(n)
+    for neighbour, other in _neighbours(start, k):
+        reach += np.where(other, np.maximum(k_distance[neighbour], \
+                    np.abs(sorted_x - sorted_x[neighbour])), 0)
+    lrd = 1/(reach/k + EPSILON)
+    density = np.zeros(n)
+    for neighbour, other in _neighbours(start, k):
+        density += np.where(other, lrd[neighbour], 0)
+    return density/k/lrd
+
+def knn_scores(sorted_x, k = 20):
+    """This function returns the k-distance of every point of a sorted array
+    relative to the mean k-distance, the inverse of the k-NN density estimate
+    k/(2 n k-distance) normalized like the density of main.KDE. Arrays of at
+    most k values use k = n - 1."""
+    n = sorted_x.size
+    k = min(k, n - 1)
+    if k < 1:
+        return np.ones(n)
+    k_distance, _ = knn_windows(sorted_x, k)
+    mean = k_distance.mean()
+    return k_distance/mean if mean > 0 else np.ones(n)
+
+_SCORES = {
+    'lof' : lof_scores,
+    'knn' : knn_scores,
+}
+
+def neighbour_scores(sorted_x, k = 20, score = 'lof'):
+    """This function returns the outlier score of every point of a sorted array.
+
+        The arguments are
+        sorted_x : The numpy array of values in increasing order
+        k : The number of neighbours
+        score : 'lof' (the Local Outlier Factor) or 'knn' (the k-distance \
+                    relative to its mean)
+
+        Larger scores are more outlying, both are about 1 for typical points.
+    """
+    if score not in _SCORES:
+        raise ValueError("Unknown neighbour score %r, expected one of %s" % \
+                                    (score, ", ".join(KNN_SCORES)))
+    return _SCORES[score](np.asarray(sorted_x, dtype = float), k)
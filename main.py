@@ -1,8 +1,23 @@
 import os
+import sys
 import numpy as np
 import get_data as gd
 import clustering as cl
+import grouped
+from kde import gauss, bandwidth, kde_density
+from knn import neighbour_scores
+from parallel import map_segments
+from cache import QueryCache
+from sparql_client import SPARQLClient
+from snapshot import save_snapshot, load_snapshot
+from output import uri_lines, write_uris
+from type_index import TypeIndex
+import instrumentation
 
+#The bits of the mask returned by find_outliers_combined
+IQR_FLAG = 1
+MAD_FLAG = 2
+KDE_FLAG = 4
 
 def iqr(data, upper, lower):
     if lower>upper:
@@ -10,6 +25,7 @@ def iqr(data, upper, lower):
     qUpper, qLower = np.percentile(data, [upper,lower])
     return qUpper - qLower
 
+@instrumentation.traced('MAD', points = 'points_scored')
 def find_outliers_using_MAD(data, multiplyingFactor=1, preprocess = False, clusters = None):
     """This function is used to find outliers using the Median Absolute Dispersion
     
@@ -26,26 +42,18 @@ def find_outliers_using_MAD(data, multiplyingFactor=1, preprocess = False, clust
 
     """
     if preprocess and clusters is not None:
-        no_of_clusters = np.max(clusters) + 1
-        indices = np.empty(shape=(0,), dtype=int)
-        for i in range(no_of_clusters):
-            data_cluster_i = data[clusters==i]
-            median = np.median(data_cluster_i)
-            MAD = np.median(np.abs(data - median))
-            indices_found = (np.where(np.abs(data_cluster_i-median)>=\
-                                        (multiplyingFactor*MAD)))
-            try:
-                original_indices = np.where(clusters==i)[0]
-                indices = np.concatenate((original_indices[indices_found[0]], indices), axis = 0)
-            except Exception as e:
-                print(e)
-                print(indices_found)
-        return indices
+        order, sorted_data, starts, counts = grouped.sort_by_cluster(data, clusters)
+        ids = grouped.segment_ids(counts)
+        median = grouped.segment_medians(sorted_data, starts, counts)
+        MAD = grouped.segment_mads(sorted_data, starts, counts, median)
+        return grouped.scatter_flags(order, np.abs(sorted_data-median[ids])>=\
+                                        (multiplyingFactor*MAD[ids]))
     else:
         median = np.median(data)
         MAD = np.median(np.abs(data - median))
         return np.where(np.abs(data-median)>=(multiplyingFactor*MAD))[0]
         
+@instrumentation.traced('IQR', points = 'points_scored')
 def find_outliers_using_IQR(data, upper = 75, lower = 25, multiplyingFactor = 1.5, \
                                               preprocess = False, clusters = None):
     """The function is used to find outliers from a given numpy array.
@@ -68,22 +76,12 @@ def find_outliers_using_IQR(data, upper = 75, lower = 25, multiplyingFactor = 1.
 
 
     if preprocess and clusters is not None:
-        no_of_clusters = np.max(clusters) + 1
-        indices = np.empty(shape=(0,), dtype=int)
-        for i in range(no_of_clusters):
-            data_cluster_i = data[clusters==i]
-            qUpper, qLower = np.percentile(data_cluster_i, [upper,lower])
-            iqrFactored = multiplyingFactor*(qUpper-qLower)
-            indices_found = np.where((data_cluster_i<(qLower-iqrFactored)) | \
-                        (data_cluster_i>(qUpper+iqrFactored)))
-
-            try:
-                original_indices = np.where(clusters==i)[0]
-                indices = np.concatenate((original_indices[indices_found[0]], indices), axis = 0)
-            except Exception as e:
-                print(e)
-                print(indices_found)
-        return indices
+        order, sorted_data, starts, counts = grouped.sort_by_cluster(data, clusters)
+        ids = grouped.segment_ids(counts)
+        qUpper, qLower = grouped.segment_percentiles(sorted_data, starts, counts, [upper,lower])
+        iqrFactored = multiplyingFactor*(qUpper-qLower)
+        return grouped.scatter_flags(order, (sorted_data<(qLower-iqrFactored)[ids]) | \
+                        (sorted_data>(qUpper+iqrFactored)[ids]))
     else:
         qUpper, qLower = np.percentile(data, [upper,lower])
         iqrFactored = multiplyingFactor*(qUpper-qLower)
@@ -97,56 +95,170 @@ def statistics(data):
     print("minimum value = ", data.min())
     print("maximum value = ", data.max())
 
-def gauss(x, mu, sigma):
-    return (1/sigma*(np.sqrt(2*np.pi)))*np.exp((-1/(2*sigma*sigma))*((x-mu)**2))
+def _kde_flags(values, h, mu, sigma, threshold, method, options):
+    """The points of one cluster whose normalized density is below the threshold"""
+    fnh = kde_density(values, h, mu, sigma, method, **options)
+    normalizing = np.sum(fnh)/values.size
+    return fnh/normalizing<threshold
+
+def _kde_arguments(counts, h, mu, sigma, threshold, method, options):
+    """The arguments of _kde_flags for every segment, None for the empty segments
+    (the labels can have gaps), which map_segments skips"""
+    return [(bandwidth(sigma[i], counts[i]) if h is None else h, mu[i], sigma[i], \
+                threshold, method, options) if counts[i] else None for i in range(counts.size)]
 
-def KDE(x, h = None, threshold = 1, preprocess = False, clusters = None):
+@instrumentation.traced('KDE', points = 'points_scored')
+def KDE(x, h = None, threshold = 1, preprocess = False, clusters = None, \
+                                            method = 'exact', processes = 1, **options):
     """The function is used to find the outliers using
-    the Kernel Density Estimation Technique"""
+    the Kernel Density Estimation Technique
+
+        The arguments are
+        x : The numpy array in which we want to find the outliers.
+        h : The bandwidth, the rule of thumb bandwidth is used if it is None
+        threshold : Points whose normalized density is below the threshold \
+                                                    are outliers
+        preprocess : This is a boolean which sets the \
+                                        options to enable preprocessing
+        clusters : The clusters which are provided if preprocess \
+                                            is set to true (numpy array)
+        method : The density backend, one of kde.KDE_METHODS ('exact', \
+                    'binned', 'tree', 'window' or 'chunked'), see \
+                    kde.kde_density for the error bounds
+        processes : The number of processes the clusters are spread over \
+                    (None for one per CPU), see parallel.map_segments
+        options : Passed on to the density backend
+
+        The function returns a numpy array which contains the indices of the numpy \
+                    array, which are outliers.
+    """
 
     if preprocess and clusters is not None:
-        indices = np.empty(shape=(0,), dtype=int)
-        no_of_clusters = np.max(clusters) + 1
-        for i in range(no_of_clusters):
-            data_cluster_i = x[clusters==i]
-            n = data_cluster_i.size
-            fnh = np.zeros(n)
-            mu = np.mean(data_cluster_i)
-            sigma = np.std(data_cluster_i)
-
-            if h is None:
-                h = (((4*(sigma**5))/(3*n))**0.2)
-           
-            for j in range(data_cluster_i.size):
-                fnh[j] = np.sum(gauss((data_cluster_i-data_cluster_i[j])/h, \
-                                mu, sigma))/(n*h)
-            
-            normalizing = np.sum(fnh)/n
-            fnh = fnh/normalizing
-            indices_found = np.where(fnh<threshold)
-            try:
-                original_indices = np.where(clusters==i)[0]
-                indices = np.concatenate((original_indices[indices_found[0]], indices), axis = 0)
-            except Exception as e:
-                print(e)
-        return indices
+        order, sorted_x, starts, counts = grouped.sort_by_cluster(x, clusters)
+        mu, sigma = grouped.segment_mean_std(sorted_x, counts)
+        #Only the density itself is evaluated segment by segment
+        flags = map_segments(_kde_flags, sorted_x, starts, counts, \
+                    _kde_arguments(counts, h, mu, sigma, threshold, method, options), processes)
+        return grouped.scatter_flags(order, flags)
     else:
         n = x.size
-        fnh = np.zeros(n)
         mu = np.mean(x)
         sigma = np.std(x)
 
         if h is None:
-            h = (((4*(sigma**5))/(3*n))**0.2)
-       
-        for i in range(x.size):
-            fnh[i] = np.sum(gauss((x-x[i])/h, mu, sigma))/(n*h)
-        
+            h = bandwidth(sigma, n)
+
+        fnh = kde_density(x, h, mu, sigma, method, **options)
         normalizing = np.sum(fnh)/n
         fnh = fnh/normalizing
         return np.where(fnh<threshold)[0]
-    
-      
+
+def _lof_flags(values, k, threshold, score):
+    return neighbour_scores(values, k, score)>threshold
+
+@instrumentation.traced('LOF', points = 'points_scored')
+def find_outliers_using_LOF(x, k = 20, threshold = 1.5, score = 'lof', preprocess = False, \
+                                                            clusters = None, processes = 1):
+    """The function is used to find the outliers using the k nearest neighbours
+    of every point, a fast alternative to KDE without a bandwidth
+
+        The arguments are
+        x : The numpy array in which we want to find the outliers.
+        k : The number of neighbours
+        threshold : Points whose score is above the threshold are outliers
+        score : 'lof' (the Local Outlier Factor) or 'knn' (the distance to \
+                    the k-th neighbour relative to its mean), see \
+                    knn.neighbour_scores
+        preprocess : This is a boolean which sets the \
+                                        options to enable preprocessing
+        clusters : The clusters which are provided if preprocess \
+                                            is set to true (numpy array)
+        processes : The number of processes the clusters are spread over \
+                    (None for one per CPU), see parallel.map_segments
+
+        The data is sorted once (by cluster and value), the neighbours of a
+        point are a window of the sorted values of its cluster, so the cost
+        is O(n log n + n k).
+
+        The function returns a numpy array which contains the indices of the numpy \
+                    array, which are outliers.
+    """
+    x = np.asarray(x, dtype = float)
+    if not (preprocess and clusters is not None):
+        clusters = np.zeros(x.size, dtype = np.intp)
+    order, sorted_x, starts, counts = grouped.sort_by_cluster(x, clusters)
+    flags = map_segments(_lof_flags, sorted_x, starts, counts, \
+                                [(k, threshold, score)]*counts.size, processes)
+    return grouped.scatter_flags(order, flags)
+
+@instrumentation.traced('combined', points = 'points_scored')
+def find_outliers_combined(data, upper = 75, lower = 25, iqrFactor = 1.5, madFactor = 1, \
+                    h = None, threshold = 1, preprocess = False, clusters = None, \
+                    method = 'exact', stats = None, processes = 1, **options):
+    """This function runs the IQR, MAD and KDE detectors together on one sorted copy of the data.
+
+        The arguments are
+        data : The numpy array in which we want to find the outliers.
+        upper, lower, iqrFactor : The arguments of find_outliers_using_IQR
+        madFactor : The multiplying factor of find_outliers_using_MAD
+        h, threshold, method, options : The arguments of KDE, with the \
+                    same 'exact' backend by default ('binned' scales to \
+                    large clusters, 'window' is fast when the kernel is narrow)
+        preprocess : This is a boolean which sets the \
+                                        options to enable preprocessing
+        clusters : The clusters which are provided if preprocess \
+                                            is set to true (numpy array)
+        stats : An optional dictionary, it is filled with the mean, median, \
+                    minimum and maximum of every cluster (see statistics)
+        processes : The number of processes the KDE of the clusters is \
+                    spread over, see parallel.map_segments
+
+        The data is sorted once (by cluster and value) and the percentiles,
+        the median, the MAD and the minimum and maximum are all read from
+        the sorted segments, as are the KDE neighbour windows with the
+        'window' backend. The MAD is selected from the two sorted runs on
+        either side of the median, so the absolute deviations are never sorted.
+
+        The function returns a numpy array of uint8 with one entry per point,
+        the sum of IQR_FLAG, MAD_FLAG and KDE_FLAG for the methods which
+        flagged it. The outliers of a method or of several methods are given
+        by outliers_flagged_by.
+    """
+    if lower>upper:
+        lower, upper = upper, lower
+    data = np.asarray(data, dtype = float)
+    if not (preprocess and clusters is not None):
+        clusters = np.zeros(data.size, dtype = np.intp)
+    order, sorted_data, starts, counts = grouped.sort_by_cluster(data, clusters)
+    ids = grouped.segment_ids(counts)
+    flags = np.zeros(sorted_data.size, dtype = np.uint8)
+
+    qUpper, qLower = grouped.segment_percentiles(sorted_data, starts, counts, [upper,lower])
+    iqrFactored = iqrFactor*(qUpper-qLower)
+    flags[(sorted_data<(qLower-iqrFactored)[ids]) | \
+                        (sorted_data>(qUpper+iqrFactored)[ids])] |= IQR_FLAG
+
+    median = grouped.segment_medians(sorted_data, starts, counts)
+    MAD = grouped.segment_mads(sorted_data, starts, counts, median)
+    flags[np.abs(sorted_data-median[ids])>=(madFactor*MAD[ids])] |= MAD_FLAG
+
+    mu, sigma = grouped.segment_mean_std(sorted_data, counts)
+    flags[map_segments(_kde_flags, sorted_data, starts, counts, \
+            _kde_arguments(counts, h, mu, sigma, threshold, method, options), processes)] |= KDE_FLAG
+
+    if stats is not None:
+        minimum, maximum = grouped.segment_extremes(sorted_data, starts, counts)
+        stats.update(mean = mu, median = median, minimum = minimum, maximum = maximum)
+    mask = np.empty_like(flags)
+    mask[order] = flags
+    return mask
+
+def outliers_flagged_by(flags, methods):
+    """This function returns the indices of the points flagged by all the given
+    methods, e.g. outliers_flagged_by(flags, IQR_FLAG | MAD_FLAG) for the overlap
+    of IQR and MAD. flags is the mask returned by find_outliers_combined."""
+    return np.flatnonzero((flags & methods) == methods)
+
 
     
 def get_data(argument, parsing_exception_file):
@@ -159,13 +271,22 @@ def get_data(argument, parsing_exception_file):
     elif argument.lower() == 'company':
         return gd.get_company_population(parsing_exception_file)
     print("Data fetched")
+
+def get_snapshot(argument, snapshot_path, parsing_exception_file):
+    """This function loads the data from the snapshot at snapshot_path (memory
+    mapped, see snapshot.load_snapshot). If there is no snapshot yet the
+    data is fetched from DBPedia and saved as the snapshot first.
+    Delete the snapshot directory to fetch the data again."""
+    if not os.path.exists(snapshot_path):
+        values, uris = get_data(argument, parsing_exception_file)
+        save_snapshot(snapshot_path, values, uris, dataset = argument)
+    return load_snapshot(snapshot_path)
     
 def print_entities_from_index(list_of_entities, index):
     """ This function will print the details given the indices.
         The arguments to the function are
-        list_of_entities : A list containing the URI entities."""
-    for i in index:
-        print(list_of_entities[i])
+        list_of_entities : A list (or columns.StringTable) containing the URI entities."""
+    sys.stdout.write(uri_lines(list_of_entities, index).decode('utf-8'))
 
 
 def find_overlap_between_multiple_arrays(array_a, array_b, *argv):
@@ -183,10 +304,9 @@ def find_overlap_between_multiple_arrays(array_a, array_b, *argv):
     return answer
 
 def write_outliers_to_file(file_name, list_of_entities, index):
-    f = open(file_name, "w")
-    for i in index:
-        f.write(list_of_entities[i] + "\n")
-    f.close()
+    """Writes the URIs of the outliers one per line in a single write, the file
+    is compressed if its name ends with .gz or .zst (see output.write_uris)"""
+    write_uris(file_name, list_of_entities, index)
 
 def check_and_create_directory(path):
     if not os.path.exists(path):
@@ -196,31 +316,49 @@ def check_and_create_directory(path):
 if __name__=="__main__":
     print("*"*80)
 
+    #Every query result is cached, set SPARQL_OFFLINE=1 to run from the cache only
+    check_and_create_directory(os.getcwd() + "/data/")
+    gd.set_client(SPARQLClient(cache = QueryCache(os.getcwd() + "/data/sparql_cache.sqlite", \
+                        offline = os.environ.get("SPARQL_OFFLINE") == "1")))
+
     #Applying numerical data on companies
 
     check_and_create_directory(os.getcwd() + "/data/company/")
-    company_name_populations = get_data('Company', os.getcwd() + "/data/company/" + "company.parsing_exception") 
-    data = np.asarray(company_name_populations[0])
+    company = get_snapshot('Company', os.getcwd() + "/data/company/snapshot", \
+                        os.getcwd() + "/data/company/" + "company.parsing_exception")
+    data = company.values
     """
     IQR_outliers = find_outliers_using_IQR(data, upper = 95, lower = 5)
     MAD_outliers = find_outliers_using_MAD(data)
     KDE_outliers = KDE(data)
     statistics(data)
     write_outliers_to_file(os.getcwd() + "/data/company/" + \
-        "company.outliers.using.IQR", company_name_populations[1], list(IQR_outliers))
+        "company.outliers.using.IQR", company.uris, list(IQR_outliers))
 
     write_outliers_to_file(os.getcwd() + "/data/company/" + \
-        "company.outliers.using.MAD", company_name_populations[1], list(MAD_outliers))
+        "company.outliers.using.MAD", company.uris, list(MAD_outliers))
 
     write_outliers_to_file(os.getcwd() + "/data/company/" + \
-        "company.outliers.using.KDE", company_name_populations[1], list(KDE_outliers))
+        "company.outliers.using.KDE", company.uris, list(KDE_outliers))
     """
-    cluster = cl.cluster(company_name_populations[1])
-    np.save(os.getcwd() + "/data/company/clusters.npy", clusters)
+    #The types of the entities are kept in one index shared by all the datasets
+    type_index = TypeIndex.load(os.getcwd() + "/data/type_index")
+    if company.clusters is None:
+        save_snapshot(os.getcwd() + "/data/company/snapshot", data, company.uris, \
+                    clusters = cl.cluster(company.uris, backend = 'bernoulli', index = type_index), \
+                    **company.manifest['metadata'])
+        type_index.save(os.getcwd() + "/data/type_index")
+        company = load_snapshot(os.getcwd() + "/data/company/snapshot")
+    cluster = company.clusters
     IQR_outliers_cluster = find_outliers_using_IQR(data, upper = 95, lower = 5,\
             preprocess = True, clusters = cluster)
+    #The k nearest neighbours in place of KDE, it scales to the whole dataset
+    LOF_outliers_cluster = find_outliers_using_LOF(data, preprocess = True, clusters = cluster, \
+                                                        processes = None)
+    write_outliers_to_file(os.getcwd() + "/data/company/" + \
+        "company.outliers.using.LOF", company.uris, list(LOF_outliers_cluster))
 
-    sys.exit(1)
+    sys.exit(0)
 
     #Applying the numerical methods on coutries
 
@@ -229,10 +367,16 @@ if __name__=="__main__":
     
     data = np.asarray(country_name_populations[0])
     print("No of datapoints", data.size)
-    IQR_outliers = find_outliers_using_IQR(data, upper = 95, lower = 5)
-    MAD_outliers = find_outliers_using_MAD(data)
-    KDE_outliers = KDE(data)
-    statistics(data)
+    country_stats = {}
+    flags = find_outliers_combined(data, upper = 95, lower = 5, method = 'exact', \
+                                                        stats = country_stats)
+    IQR_outliers = outliers_flagged_by(flags, IQR_FLAG)
+    MAD_outliers = outliers_flagged_by(flags, MAD_FLAG)
+    KDE_outliers = outliers_flagged_by(flags, KDE_FLAG)
+    print("mean = ", country_stats['mean'][0])
+    print("median = ", country_stats['median'][0])
+    print("minimum value = ", country_stats['minimum'][0])
+    print("maximum value = ", country_stats['maximum'][0])
     write_outliers_to_file(os.getcwd() + "/data/countries/" + \
             "countries.outliers.using.IQR", country_name_populations[1], list(IQR_outliers))
 
@@ -242,18 +386,17 @@ if __name__=="__main__":
     write_outliers_to_file(os.getcwd() + "/data/countries/" + \
             "countries.outliers.using.KDE", country_name_populations[1], list(KDE_outliers))
 
-    clusters = cl.cluster(country_name_populations[1])
-    
     print("Number of outliers using IQR = ", IQR_outliers.size)
     print("Number of outliers using MAD = ", MAD_outliers.size)
     print("Number of outliers using KDE = ", KDE_outliers.size)
-    overlap = find_overlap_between_multiple_arrays(IQR_outliers[0], MAD_outliers[0], KDE_outliers[0])
+    overlap = outliers_flagged_by(flags, IQR_FLAG | MAD_FLAG | KDE_FLAG)
     print("Number of outliers using common to IQR, MAD and KDE = ", len(overlap))
     print_entities_from_index(country_name_populations[1], overlap)
     #Using the clustering module
     
     #Using the clustering Module
-    clusters = cl.cluster(country_name_populations[1])
+    clusters = cl.cluster(country_name_populations[1], index = type_index)
+    type_index.save(os.getcwd() + "/data/type_index")
     iqr_ol = find_outliers_using_IQR(data, upper = 75, lower = 25, \
         multiplyingFactor = 1.5, preprocess = True, clusters = clusters)
     overlap = find_overlap_between_multiple_arrays(IQR_outliers, iqr_ol)
@@ -0,0 +1,338 @@
+import argparse
+import bisect
+import csv
+import io
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from cache import QueryCache
+from sparql_client import DBPEDIA_ENDPOINT, RESULT_FORMATS
+
+XSD = "http://www.w3.org/2001/XMLSchema#"
+
+_MEDIA_TYPES = dict((media_type, format) for format, media_type in RESULT_FORMATS.items())
+
+
+class UnsupportedQuery(Exception):
+    pass
+
+
+def _tsv_term(term):
+    if term['type'] == 'uri':
+        return "<" + term['value'] + ">"
+    text = '"' + term['value'].replace('\\', '\\\\').replace('"', '\\"').replace('\t', '\\t')\
+                                        .replace('\n', '\\n') + '"'
+    return text + ("^^<" + term['datatype'] + ">" if 'datatype' in term else "")
+
+def serialize(variables, bindings, format = 'json'):
+    """Returns the text of a SELECT result (variables and a list of JSON
+    bindings) in one of the formats of sparql_client.RESULT_FORMATS"""
+    if format == 'json':
+        return json.dumps({'head' : {'vars' : variables}, 'results' : {'bindings' : bindings}})
+    if format == 'csv':
+        f = io.StringIO()
+        writer = csv.writer(f, lineterminator = "\r\n")
+        writer.writerow(variables)
+        writer.writerows([[each[name]['value'] if name in each else "" for name in variables] \
+                                                                    for each in bindings])
+        return f.getvalue()
+    lines = ["\t".join("?" + name for name in variables)]
+    lines.extend("\t".join(_tsv_term(each[name]) if name in each else "" for name in variables) \
+                                                                    for each in bindings)
+    return "\n".join(lines) + "\n"
+
+
+class SyntheticBackend(object):
+    """Answers the queries of get_data from datasets held in memory.
+
+        The arguments are
+        datasets : A dictionary of property (as written in the query, e.g. \
+                    'dbo:numberOfEmployees') : (uris, lexical values)
+        types : A dictionary of entity URI : list of type URIs
+        datatype : The datatype of the values
+        max_rows : Results are cut after max_rows rows like those of \
+                    DBPedia (see get_data.MAX_ROWS), None for no limit
+
+        Three query shapes are understood: the keyset pages of
+        get_data.iter_property_pages (STR(?entity) range filters, ORDER BY
+        and LIMIT), the VALUES batches of get_data.get_types_batch and its
+        pages of the types of a single entity (ORDER BY ?concept, LIMIT and
+        OFFSET). The class in the graph pattern is not checked. Anything
+        else raises UnsupportedQuery.
+    """
+
+    def __init__(self, datasets = None, types = None, datatype = XSD + "integer", max_rows = None):
+        self.datasets = {}
+        for name, (uris, values) in (datasets or {}).items():
+            rows = sorted(zip(uris, values))
+            self.datasets[name] = ([each[0] for each in rows], [each[1] for each in rows])
+        self.types = types or {}
+        self.datatype = datatype
+        self.max_rows = max_rows
+
+    _PROPERTY = re.compile(r'\?entity\s+(\S+)\s+\?value')
+    _LOW = re.compile(r'STR\(\?entity\)\s*>=\s*"((?:[^"\\]|\\.)*)"')
+    _HIGH = re.compile(r'STR\(\?entity\)\s*<\s*"((?:[^"\\]|\\.)*)"')
+    _LIMIT = re.compile(r'LIMIT\s+(\d+)', re.IGNORECASE)
+    _VALUES = re.compile(r'VALUES\s+\?entity\s*\{([^}]*)\}', re.IGNORECASE)
+    _ENTITY = re.compile(r'<([^>]*)>\s+a\s+\?concept')
+    _OFFSET = re.compile(r'OFFSET\s+(\d+)', re.IGNORECASE)
+
+    def respond(self, query, format):
+        values = self._VALUES.search(query)
+        if values is not None:
+            bindings = [{'entity' : {'type' : 'uri', 'value' : entity}, \
+                        'concept' : {'type' : 'uri', 'value' : concept}} \
+                        for entity in re.findall(r'<([^>]*)>', values.group(1)) \
+                        for concept in self.types.get(entity, [])][:self.max_rows]
+            return serialize(['entity', 'concept'], bindings, format)
+        entity = self._ENTITY.search(query)
+        if entity is not None:
+            concepts = sorted(self.types.get(entity.group(1), []))
+            offset, limit = self._OFFSET.search(query), self._LIMIT.search(query)
+            start = int(offset.group(1)) if offset else 0
+            stop = start + int(limit.group(1)) if limit else len(concepts)
+            if self.max_rows is not None:
+                stop = min(stop, start + self.max_rows)
+            return serialize(['concept'], [{'concept' : {'type' : 'uri', 'value' : each}} \
+                                                    for each in concepts[start:stop]], format)
+        match = self._PROPERTY.search(query)
+        if match is None or match.group(1) not in self.datasets:
+            raise UnsupportedQuery("No synthetic data for this query")
+        uris, lexical = self.datasets[match.group(1)]
+        unescape = lambda m: re.sub(r'\\(.)', r'\1', m.group(1))
+        low, high = self._LOW.search(query), self._HIGH.search(query)
+        start = bisect.bisect_left(uris, unescape(low)) if low else 0
+        stop = bisect.bisect_left(uris, unescape(high)) if high else len(uris)
+        limit = self._LIMIT.search(query)
+        if limit is not None:
+            stop = min(stop, start + int(limit.group(1)))
+        bindings = [{'entity' : {'type' : 'uri', 'value' : uris[i]}, \
+                    'value' : {'type' : 'typed-literal', 'datatype' : self.datatype, \
+                                    'value' : lexical[i]}} for i in range(start, stop)]
+        return serialize(['entity', 'value'], bindings, format)
+
+
+class RdflibBackend(object):
+    """Answers any SPARQL query from an rdflib Graph (rdflib is optional), e.g.
+    RdflibBackend.load('sample.ttl') for a small extract of DBpedia."""
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    @classmethod
+    def load(cls, path, format = None):
+        try:
+            import rdflib
+        except ImportError:
+            raise ImportError("The rdflib backend needs the rdflib package (pip3 install rdflib)")
+        graph = rdflib.Graph()
+        graph.parse(path, format = format)
+        return cls(graph)
+
+    def respond(self, query, format):
+        result = self.graph.query(query)
+        variables = [str(each) for each in result.vars]
+        bindings = []
+        for row in result:
+            binding = {}
+            for name, term in zip(variables, row):
+                if term is None:
+                    continue
+                if type(term).__name__ == 'URIRef':
+                    binding[name] = {'type' : 'uri', 'value' : str(term)}
+                else:
+                    binding[name] = {'type' : 'literal', 'value' : str(term)}
+                    if getattr(term, 'datatype', None) is not None:
+                        binding[name]['datatype'] = str(term.datatype)
+            bindings.append(binding)
+        return serialize(variables, bindings, format)
+
+
+class ReplayBackend(object):
+    """Replays the responses recorded in a cache.QueryCache file (e.g. the
+    data/sparql_cache.sqlite of earlier runs against endpoint). Queries which
+    were never recorded raise UnsupportedQuery."""
+
+    def __init__(self, cache_path, endpoint = DBPEDIA_ENDPOINT):
+        self.cache = QueryCache(cache_path, offline = True)
+        self.endpoint = endpoint
+
+    def respond(self, query, format):
+        result = self.cache.get(self.endpoint, query, format)
+        if result is None:
+            raise UnsupportedQuery("The query was not recorded")
+        return json.dumps(result) if format == 'json' else result
+
+
+class MockSPARQLServer(object):
+    """A local SPARQL endpoint over HTTP for offline and load tests.
+
+        The arguments are
+        backend : The object answering the queries (SyntheticBackend, \
+                    RdflibBackend or ReplayBackend)
+        host, port : The address to listen on, port 0 picks a free port
+        latency : The seconds every response is delayed
+        jitter : A random extra delay of up to jitter seconds
+        error_rate : The fraction of requests answered with error_status
+        error_status : The HTTP status of the injected errors (503 is \
+                    retried by sparql_client.SPARQLClient)
+        drop_rate : The fraction of connections closed without an answer
+        random_state : The seed of the injected errors
+
+        It speaks HTTP/1.1 with keep-alive like a real endpoint, and counts
+        the requests, injected errors and bytes sent. Use it as a context
+        manager, or call start() and stop(). url is the endpoint URL to give
+        to SPARQLClient (or to set in SPARQL_ENDPOINT).
+    """
+
+    def __init__(self, backend, host = "127.0.0.1", port = 0, latency = 0, jitter = 0, \
+                error_rate = 0, error_status = 503, drop_rate = 0, random_state = None):
+        self.backend = backend
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.drop_rate = drop_rate
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self._random = random.Random(random_state)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://%s:%d/sparql" % (host, port)
+
+    def _draw(self):
+        with self._lock:
+            self.requests += 1
+            return self._random.random(), self._random.random()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _answer(self, status, content_type, text):
+                body = text.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with server._lock:
+                    server.bytes_sent += len(body)
+
+            def _handle(self, parameters):
+                delay = server.latency + server._random.random()*server.jitter
+                error, drop = server._draw()
+                if delay:
+                    time.sleep(delay)
+                if drop < server.drop_rate:
+                    self.close_connection = True
+                    return
+                if error < server.error_rate:
+                    with server._lock:
+                        server.errors += 1
+                    self._answer(server.error_status, 'text/plain', "Injected error")
+                    return
+                query = parameters.get('query', [None])[0]
+                if query is None:
+                    self._answer(400, 'text/plain', "Missing query")
+                    return
+                accept = self.headers.get('Accept', RESULT_FORMATS['json']).split(',')[0].strip()
+                format = _MEDIA_TYPES.get(accept, 'json')
+                try:
+                    text = server.backend.respond(query, format)
+                except UnsupportedQuery as e:
+                    self._answer(404 if isinstance(server.backend, ReplayBackend) else 400, \
+                                                                'text/plain', str(e))
+                    return
+                self._answer(200, RESULT_FORMATS[format], text)
+
+            def do_GET(self):
+                self._handle(parse_qs(urlsplit(self.path).query))
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self._handle(parse_qs(self.rfile.read(length).decode('utf-8')))
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target = self._server.serve_forever, daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+
+def synthetic_backend(n, property_name = 'dbo:numberOfEmployees', random_state = 0):
+    """A SyntheticBackend with n entities shaped like DBpedia (the values and
+    clustered types of benchmark.py)"""
+    import benchmark
+    values, _ = benchmark.make_values(n, random_state = random_state)
+    labels, X = benchmark.make_types(n, random_state = random_state)
+    uris = ["http://dbpedia.org/resource/Entity_%07d" % i for i in range(n)]
+    names = ["http://dbpedia.org/ontology/Type%d" % i for i in range(X.shape[1])]
+    types = dict((uri, [names[j] for j in X.indices[X.indptr[i]:X.indptr[i + 1]]]) \
+                                                    for i, uri in enumerate(uris))
+    return SyntheticBackend({property_name : (uris, ["%d" % each for each in values])}, types)
+
+
+if __name__=="__main__":
+    #python3 mock_endpoint.py --synthetic 100000 --latency 0.05 --error-rate 0.01
+    #SPARQL_ENDPOINT=http://127.0.0.1:8890/sparql python3 batch.py specs.txt
+    parser = argparse.ArgumentParser(description = "Runs a local SPARQL endpoint")
+    source = parser.add_mutually_exclusive_group(required = True)
+    source.add_argument('--synthetic', type = int, metavar = 'N', \
+                    help = "Serve N synthetic entities (dbo:numberOfEmployees and types)")
+    source.add_argument('--rdf', metavar = 'FILE', help = "Serve an RDF file with rdflib")
+    source.add_argument('--replay', metavar = 'CACHE', help = "Replay a SPARQL cache file")
+    parser.add_argument('--endpoint', default = DBPEDIA_ENDPOINT, \
+                    help = "The endpoint the replayed responses were recorded from")
+    parser.add_argument('--host', default = "127.0.0.1")
+    parser.add_argument('--port', type = int, default = 8890)
+    parser.add_argument('--latency', type = float, default = 0)
+    parser.add_argument('--jitter', type = float, default = 0)
+    parser.add_argument('--error-rate', type = float, default = 0)
+    parser.add_argument('--drop-rate', type = float, default = 0)
+    args = parser.parse_args()
+
+    if args.synthetic is not None:
+        backend = synthetic_backend(args.synthetic)
+    elif args.rdf is not None:
+        backend = RdflibBackend.load(args.rdf)
+    else:
+        backend = ReplayBackend(args.replay, args.endpoint)
+    server = MockSPARQLServer(backend, args.host, args.port, args.latency, args.jitter, \
+                                    args.error_rate, drop_rate = args.drop_rate)
+    print("Serving on", server.url)
+    server.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
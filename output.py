@@ -0,0 +1,107 @@
+import gzip
+import numpy as np
+from columns import StringTable
+
+#The compressions of write_uris, chosen from the file name if not given
+COMPRESSIONS = ('gzip', 'zstd')
+_EXTENSIONS = {'.gz' : 'gzip', '.zst' : 'zstd'}
+
+
+def _open(path, compression):
+    if compression is None:
+        return open(path, "wb")
+    if compression == 'gzip':
+        return gzip.open(path, "wb", compresslevel = 6)
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstd output needs the zstandard package (pip3 install zstandard)")
+        return zstandard.ZstdCompressor(level = 3).stream_writer(open(path, "wb"))
+    raise ValueError("Unknown compression %r, expected one of %s" % \
+                                            (compression, ", ".join(COMPRESSIONS)))
+
+def _compression_of(path):
+    for extension, compression in _EXTENSIONS.items():
+        if path.endswith(extension):
+            return compression
+    return None
+
+def uri_lines(uris, indices = None):
+    """Returns the URIs of the given rows as one bytes object with one URI per
+    line. uris is a columns.StringTable (gathered without a str per row) or
+    a list of strings."""
+    if isinstance(uris, StringTable):
+        return uris.lines(indices)
+    selected = uris if indices is None else [uris[i] for i in indices]
+    return "".join(each + "\n" for each in selected).encode('utf-8')
+
+def write_uris(path, uris, indices = None, compression = 'auto'):
+    """This function writes the URIs of the given rows to a file, one per line,
+    in a single write.
+
+        The arguments are
+        path : The output file
+        uris : The columns.StringTable (or list) of the URIs
+        indices : The rows to write, all of them if None
+        compression : None, 'gzip' or 'zstd' (needs the zstandard package), \
+                    by default chosen from the extension (.gz or .zst)
+    """
+    if compression == 'auto':
+        compression = _compression_of(path)
+    with _open(path, compression) as f:
+        f.write(uri_lines(uris, indices))
+
+def save_results(path, uris, values, indices, scores = None, flags = None, format = 'npz'):
+    """This function saves outliers with their URIs, values, scores and method
+    flags in one structured file.
+
+        The arguments are
+        path : The output file
+        uris, values : The URIs (columns.StringTable or list) and the values \
+                    of the whole dataset
+        indices : The rows of the outliers
+        scores : An optional score per outlier (e.g. the normalized density)
+        flags : An optional method bitmask per outlier (main.IQR_FLAG, ...)
+        format : 'npz' (compressed numpy arrays) or 'parquet' (needs pyarrow)
+
+        In the NPZ file the URIs are stored like a columns.StringTable, as
+        the bytes uri_data and the boundaries uri_offsets, so load_results
+        reads them back without a Python object per row.
+    """
+    indices = np.asarray(indices, dtype = np.int64)
+    if not isinstance(uris, StringTable):
+        uris = StringTable.from_strings(uris)
+    selected = uris.take(indices)
+    lengths = np.diff(selected.offsets)[selected.codes]
+    columns = {
+        'index' : indices,
+        'value' : np.asarray(values)[indices],
+    }
+    if scores is not None:
+        columns['score'] = np.asarray(scores, dtype = np.float64)
+    if flags is not None:
+        columns['flags'] = np.asarray(flags, dtype = np.uint8)
+    if format == 'npz':
+        data = np.frombuffer(selected.lines(separator = b""), dtype = np.uint8)
+        np.savez_compressed(path, uri_data = data, \
+                    uri_offsets = np.concatenate(([0], np.cumsum(lengths))), **columns)
+    elif format == 'parquet':
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output needs the pyarrow package (pip3 install pyarrow)")
+        arrays = dict((name, pyarrow.array(column)) for name, column in columns.items())
+        arrays['uri'] = pyarrow.array(selected.tolist(), type = pyarrow.string())
+        pyarrow.parquet.write_table(pyarrow.table(arrays), path, compression = 'zstd')
+    else:
+        raise ValueError("Unknown format %r, expected 'npz' or 'parquet'" % format)
+
+def load_results(path):
+    """Reads a file written by save_results with format = 'npz'. It returns a
+    dictionary of the columns, with the URIs as a columns.StringTable under 'uri'."""
+    with np.load(path) as f:
+        columns = dict((name, f[name]) for name in f.files)
+    columns['uri'] = StringTable(columns.pop('uri_data'), columns.pop('uri_offsets'))
+    return columns
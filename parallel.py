@@ -0,0 +1,94 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+#The views on the shared arrays, set in every worker process by _attach
+_shared = {}
+
+
+def _share(array):
+    """Copies an array into a new shared memory block, it returns the block
+    and the numpy view on it"""
+    block = shared_memory.SharedMemory(create = True, size = max(array.nbytes, 1))
+    view = np.ndarray(array.shape, dtype = array.dtype, buffer = block.buf)
+    view[...] = array
+    return block, view
+
+def _open(name, shape, dtype):
+    try:
+        block = shared_memory.SharedMemory(name = name, track = False)
+    except TypeError:
+        #Before Python 3.13 the block is registered with the resource tracker
+        #again, the workers share the tracker of the parent so it is unlinked once
+        block = shared_memory.SharedMemory(name = name)
+    return block, np.ndarray(shape, dtype = dtype, buffer = block.buf)
+
+def _attach(data, flags):
+    """The initializer of the workers: opens the shared values and flags once per process"""
+    _shared['data'] = _open(*data)
+    _shared['flags'] = _open(*flags)
+
+def _run(function, start, count, arguments):
+    segment = slice(start, start + count)
+    _shared['flags'][1][segment] = function(_shared['data'][1][segment], *arguments)
+    return start
+
+def map_segments(function, sorted_data, starts, counts, arguments = None, processes = 1):
+    """This function flags the points of every cluster segment, the segments
+    in parallel on a process pool.
+
+        The arguments are
+        function : A function of the sorted values of one segment (and the \
+                    arguments of the segment) which returns a boolean flag \
+                    per value, e.g. the KDE density below the threshold. It \
+                    has to be defined at the top level of a module.
+        sorted_data, starts, counts : The sorted segments of \
+                    grouped.sort_by_cluster
+        arguments : A tuple of extra arguments per segment (e.g. its \
+                    bandwidth), none by default
+        processes : The number of worker processes, None for one per CPU. \
+                    With 1 (or a single segment) the segments are flagged \
+                    one after another in this process.
+
+        The sorted values and the flags are put in shared memory once, so the
+        workers read their segment and write its flags in place without any
+        copy or pickling of the data. The segments are submitted largest
+        first, as the cost of a segment grows with its size (quadratically
+        for the exact KDE), so a large cluster does not start last and hold
+        up the run. Every segment has its own slice of the flags, so the
+        result does not depend on the order the workers finish in.
+
+        It returns the boolean flags of sorted_data.
+    """
+    sorted_data = np.ascontiguousarray(sorted_data)
+    segments = np.flatnonzero(counts)
+    if arguments is None:
+        arguments = [()]*len(counts)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, segments.size)
+    if processes <= 1:
+        flags = np.zeros(sorted_data.size, dtype = bool)
+        for i in segments:
+            segment = slice(starts[i], starts[i] + counts[i])
+            flags[segment] = function(sorted_data[segment], *arguments[i])
+        return flags
+
+    data_block = _share(sorted_data)[0]
+    flags_block, flags = _share(np.zeros(sorted_data.size, dtype = bool))
+    try:
+        with ProcessPoolExecutor(max_workers = processes, initializer = _attach, \
+                initargs = ((data_block.name, sorted_data.shape, sorted_data.dtype), \
+                        (flags_block.name, flags.shape, flags.dtype))) as executor:
+            largest_first = segments[np.argsort(-counts[segments], kind = 'stable')]
+            futures = [executor.submit(_run, function, int(starts[i]), int(counts[i]), \
+                                            arguments[i]) for i in largest_first]
+            for future in futures:
+                future.result()
+        return flags.copy()
+    finally:
+        del flags
+        for block in (data_block, flags_block):
+            block.close()
+            block.unlink()
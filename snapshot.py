@@ -0,0 +1,115 @@
+import json
+import os
+import shutil
+import time
+import numpy as np
+from columns import StringTable
+
+MANIFEST = "manifest.json"
+FORMAT_VERSION = 1
+
+
+class Snapshot(object):
+    """A dataset loaded from a snapshot directory.
+
+        The attributes are
+        values : The numpy array of the values
+        uris : The columns.StringTable of the entity URIs
+        clusters : The numpy array of the cluster labels, or None
+        features : The type feature matrix (numpy array or scipy CSR \
+                                                    matrix), or None
+        manifest : The dictionary stored in the manifest
+    """
+
+    def __init__(self, values, uris, clusters, features, manifest):
+        self.values = values
+        self.uris = uris
+        self.clusters = clusters
+        self.features = features
+        self.manifest = manifest
+
+    def __len__(self):
+        return self.values.size
+
+
+def save_snapshot(path, values, uris, clusters = None, features = None, **metadata):
+    """This function saves a dataset as a directory of .npy files and a manifest.
+
+        The arguments are
+        path : The snapshot directory, an existing snapshot is replaced
+        values : The values (numpy array or list)
+        uris : The entity URIs (columns.StringTable or list of strings)
+        clusters : The cluster labels of the values (optional)
+        features : The type feature matrix, dense or scipy sparse (optional)
+        metadata : Stored in the manifest (e.g. the class and the property)
+
+        Every array is written to its own .npy file, so load_snapshot can
+        memory map all of them. The snapshot is written next to path and
+        renamed into place, so readers never see a half written snapshot.
+    """
+    if not isinstance(uris, StringTable):
+        uris = StringTable.from_strings(uris)
+    arrays = {
+        'values' : np.asarray(values),
+        'uri_data' : uris.data,
+        'uri_offsets' : uris.offsets,
+        'uri_codes' : uris.codes,
+    }
+    if clusters is not None:
+        arrays['clusters'] = np.asarray(clusters)
+    manifest = {
+        'version' : FORMAT_VERSION,
+        'created' : time.time(),
+        'rows' : int(arrays['values'].size),
+        'metadata' : metadata,
+    }
+    if features is not None:
+        if hasattr(features, 'tocsr'):
+            features = features.tocsr()
+            arrays['features_data'] = features.data
+            arrays['features_indices'] = features.indices
+            arrays['features_indptr'] = features.indptr
+            manifest['features'] = {'format' : 'csr', 'shape' : list(features.shape)}
+        else:
+            arrays['features'] = np.asarray(features)
+            manifest['features'] = {'format' : 'dense', 'shape' : list(features.shape)}
+    manifest['arrays'] = {name : {'dtype' : array.dtype.str, 'shape' : list(array.shape)} \
+                                                    for name, array in arrays.items()}
+
+    temporary = path.rstrip(os.sep) + ".tmp"
+    if os.path.exists(temporary):
+        shutil.rmtree(temporary)
+    os.makedirs(temporary)
+    for name, array in arrays.items():
+        np.save(os.path.join(temporary, name + ".npy"), np.ascontiguousarray(array))
+    with open(os.path.join(temporary, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent = 1)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(temporary, path)
+
+def load_snapshot(path, mmap_mode = 'r'):
+    """This function opens a snapshot saved by save_snapshot.
+
+        With the default mmap_mode the arrays are memory mapped read only,
+        so loading takes the same time for any size, nothing is copied and
+        processes which open the same snapshot share the page cache.
+        Pass mmap_mode = None to read the arrays into memory.
+
+        It returns a Snapshot.
+    """
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    arrays = {name : np.load(os.path.join(path, name + ".npy"), mmap_mode = mmap_mode) \
+                                                    for name in manifest['arrays']}
+    uris = StringTable(arrays['uri_data'], arrays['uri_offsets'], arrays['uri_codes'])
+    features = None
+    if 'features' in manifest:
+        if manifest['features']['format'] == 'csr':
+            from scipy import sparse
+            features = sparse.csr_matrix((arrays['features_data'], arrays['features_indices'], \
+                        arrays['features_indptr']), shape = tuple(manifest['features']['shape']), \
+                                                                        copy = False)
+        else:
+            features = arrays['features']
+    return Snapshot(arrays['values'], uris, arrays.get('clusters'), features, manifest)
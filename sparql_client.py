@@ -0,0 +1,142 @@
+import json
+import os
+import random
+import time
+import http.client
+from queue import LifoQueue, Empty
+from urllib.parse import urlsplit, urlencode
+from cache import CacheMiss
+import instrumentation
+
+DBPEDIA_ENDPOINT = "http://dbpedia.org/sparql"
+#SPARQL_ENDPOINT=http://127.0.0.1:8890/sparql points every client without an endpoint elsewhere
+ENVIRONMENT_VARIABLE = "SPARQL_ENDPOINT"
+
+#HTTP status codes after which a query is tried again
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+#The media types of the result formats which can be requested
+RESULT_FORMATS = {
+    'json' : 'application/sparql-results+json',
+    'csv' : 'text/csv',
+    'tsv' : 'text/tab-separated-values',
+}
+
+
+class SPARQLError(Exception):
+    pass
+
+
+def default_endpoint():
+    """Returns the endpoint of the SPARQL_ENDPOINT environment variable, or
+    DBpedia if it is not set (e.g. a local mock_endpoint.MockSPARQLServer)"""
+    return os.environ.get(ENVIRONMENT_VARIABLE) or DBPEDIA_ENDPOINT
+
+
+class SPARQLClient(object):
+    """A small SPARQL over HTTP client which keeps its connections alive.
+
+        SPARQLWrapper opens a new connection for every query. This client
+        keeps up to pool_size idle keep-alive connections to the endpoint,
+        so it can be shared by several worker threads, and every query is
+        retried with exponential backoff (and jitter) after connection
+        errors and the status codes in RETRY_STATUS.
+
+        The arguments are
+        endpoint : The URL of the SPARQL endpoint, by default the one of \
+                    default_endpoint()
+        pool_size : The number of idle connections which are kept open
+        timeout : The socket timeout in seconds
+        retries : How often a failed query is tried again
+        backoff : The delay before the first retry in seconds, it doubles \
+                                                    after every retry
+        cache : An optional cache.QueryCache, queries whose result is in the \
+                                            cache are not sent at all
+    """
+
+    def __init__(self, endpoint = None, pool_size = 4, timeout = 120, \
+                                    retries = 3, backoff = 0.5, cache = None):
+        endpoint = endpoint or default_endpoint()
+        parts = urlsplit(endpoint)
+        self.endpoint = endpoint
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache
+        self._connection_class = http.client.HTTPSConnection \
+                    if parts.scheme == 'https' else http.client.HTTPConnection
+        self._host = parts.hostname
+        self._port = parts.port
+        self._path = parts.path or "/"
+        self._idle = LifoQueue()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            return self._connection_class(self._host, self._port, timeout = self.timeout)
+
+    def _release(self, connection):
+        if self._idle.qsize() < self.pool_size:
+            self._idle.put(connection)
+        else:
+            connection.close()
+
+    def query(self, query, format = 'json'):
+        """Runs a SELECT query and returns the result, decoded if the format
+        is 'json' and as text for 'csv' and 'tsv'"""
+        if self.cache is not None:
+            result = self.cache.get(self.endpoint, query, format)
+            if result is not None:
+                instrumentation.count('cache_hits')
+                return result
+            if self.cache.offline:
+                raise CacheMiss("Query is not cached and the cache is offline:\n" + query)
+        with instrumentation.span('sparql_query', format = format):
+            result = self._query(query, format)
+        if self.cache is not None:
+            self.cache.put(self.endpoint, query, result, format)
+        return result
+
+    def _query(self, query, format):
+        body = urlencode({'query' : query}).encode('utf-8')
+        headers = {
+            'Content-Type' : 'application/x-www-form-urlencoded',
+            'Accept' : RESULT_FORMATS[format],
+            'Connection' : 'keep-alive',
+        }
+        for attempt in range(self.retries + 1):
+            connection = self._acquire()
+            instrumentation.count('queries_issued')
+            try:
+                connection.request('POST', self._path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                error = e
+            else:
+                if response.will_close:
+                    connection.close()
+                else:
+                    self._release(connection)
+                instrumentation.count('bytes_received', len(data))
+                if response.status == 200:
+                    text = data.decode('utf-8')
+                    return json.loads(text) if format == 'json' else text
+                error = SPARQLError("HTTP %d from %s: %s" % (response.status, \
+                                    self.endpoint, data[:200].decode('utf-8', 'replace')))
+                if response.status not in RETRY_STATUS:
+                    raise error
+            if attempt < self.retries:
+                instrumentation.count('query_retries')
+                time.sleep(self.backoff*(2**attempt)*(1 + random.random()))
+        raise error
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                return
@@ -0,0 +1,161 @@
+import numpy as np
+
+
+class KLLSketch(object):
+    """A mergeable quantile sketch (Karnin, Lang and Liberty, 2016).
+
+        The sketch keeps a few sorted compactors. An item on level h stands for
+        2**h values of the stream, and a level which grows beyond its capacity
+        (k on the top level, shrinking by 2/3 per level below) is compacted by
+        promoting every other item of the sorted level, starting at a random
+        offset. It keeps O(k) items for any stream length, and sketches
+        built on different chunks or workers can be merged.
+
+        The rank error (the difference between the returned and the true rank
+        of a quantile, as a fraction of the stream length) is about
+        2.3/k**0.97 with 99% confidence, that is about 0.3% for the default
+        k = 1000 and 1.7% for k = 200. NaN values are ignored.
+    """
+
+    def __init__(self, k = 1000, random_state = None):
+        self.k = k
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self._rng = np.random.RandomState(random_state)
+
+    def _capacity(self, level):
+        return max(2, int(np.ceil(self.k*(2/3.)**(len(self.levels) - 1 - level))))
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            if self.levels[h].size > self._capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(self.levels[h])
+                keep = items[items.size - items.size % 2:]
+                items = items[:items.size - items.size % 2]
+                self.levels[h] = keep
+                self.levels[h + 1] = np.concatenate((self.levels[h + 1], \
+                                                items[self._rng.randint(2)::2]))
+            h += 1
+
+    def update(self, values):
+        """Adds a chunk of values (any array like) to the sketch"""
+        values = np.asarray(values, dtype = float).ravel()
+        values = values[~np.isnan(values)]
+        self.n += values.size
+        self.levels[0] = np.concatenate((self.levels[0], values))
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """Adds all the values summarized by another sketch"""
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for h, items in enumerate(other.levels):
+            self.levels[h] = np.concatenate((self.levels[h], items))
+        self.n += other.n
+        self._compress()
+        return self
+
+    def weighted_items(self):
+        """Returns the sorted items of the sketch and the number of values each stands for"""
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(each.size, 2.**h) for h, each in enumerate(self.levels)])
+        order = np.argsort(items, kind = 'mergesort')
+        return items[order], weights[order]
+
+    def percentile(self, q):
+        """Returns the approximate q-th percentile(s) of the values, like np.percentile"""
+        items, weights = self.weighted_items()
+        return _weighted_percentile(items, weights, q)
+
+
+def _weighted_percentile(sorted_items, weights, q):
+    if sorted_items.size == 0:
+        return np.full(np.shape(q), np.nan)
+    cumulative = np.cumsum(weights)
+    rank = np.asarray(q, dtype = float)/100.*cumulative[-1]
+    index = np.minimum(np.searchsorted(cumulative, rank, side = 'left'), sorted_items.size - 1)
+    return sorted_items[index]
+
+
+class StreamingIQR(object):
+    """The IQR detector of main.find_outliers_using_IQR for data which is
+    processed in chunks.
+
+        The arguments are the ones of find_outliers_using_IQR, k is the size
+        of the KLLSketch (see its rank error bound).
+
+        update(chunk) adds values, merge(other) adds the values seen by another
+        detector (e.g. of another partition or worker) and flag(chunk) returns
+        the indices of the outliers within a chunk, using the percentiles of
+        all the values seen so far.
+    """
+
+    def __init__(self, upper = 75, lower = 25, multiplyingFactor = 1.5, k = 1000, \
+                                                            random_state = None):
+        if lower>upper:
+            lower, upper = upper, lower
+        self.upper = upper
+        self.lower = lower
+        self.multiplyingFactor = multiplyingFactor
+        self.sketch = KLLSketch(k, random_state)
+
+    def update(self, chunk):
+        self.sketch.update(chunk)
+        return self
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+        return self
+
+    def bounds(self):
+        """Returns the lowest and highest values which are not outliers"""
+        qUpper, qLower = self.sketch.percentile([self.upper, self.lower])
+        iqrFactored = self.multiplyingFactor*(qUpper-qLower)
+        return qLower-iqrFactored, qUpper+iqrFactored
+
+    def flag(self, chunk):
+        chunk = np.asarray(chunk)
+        low, high = self.bounds()
+        return np.where((chunk<low) | (chunk>high))[0]
+
+
+class StreamingMAD(object):
+    """The MAD detector of main.find_outliers_using_MAD for data which is
+    processed in chunks, with the same update, merge and flag methods as
+    StreamingIQR.
+
+        The absolute deviations can only be computed once the median is known,
+        so instead of a second pass the MAD is the weighted median of the
+        absolute deviations of the items of the value sketch. Values within
+        t of the median are the values ranked between median - t and
+        median + t, so the rank error of the MAD is at most about twice the
+        one of the sketch.
+    """
+
+    def __init__(self, multiplyingFactor = 1, k = 1000, random_state = None):
+        self.multiplyingFactor = multiplyingFactor
+        self.sketch = KLLSketch(k, random_state)
+
+    def update(self, chunk):
+        self.sketch.update(chunk)
+        return self
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+        return self
+
+    def median_and_MAD(self):
+        items, weights = self.sketch.weighted_items()
+        median = _weighted_percentile(items, weights, 50)
+        deviation = np.abs(items - median)
+        order = np.argsort(deviation, kind = 'mergesort')
+        return median, _weighted_percentile(deviation[order], weights[order], 50)
+
+    def flag(self, chunk):
+        chunk = np.asarray(chunk)
+        median, MAD = self.median_and_MAD()
+        return np.where(np.abs(chunk-median)>=(self.multiplyingFactor*MAD))[0]
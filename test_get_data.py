@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+import get_data as gd
+from mock_endpoint import MockSPARQLServer, SyntheticBackend
+from sparql_client import SPARQLClient
+
+
+def make_types(n, random_state = 0):
+    """Up to 3 types for every entity, and 25 for the first one"""
+    rng = np.random.RandomState(random_state)
+    uris = ["http://dbpedia.org/resource/Entity_%04d" % i for i in range(n)]
+    types = dict((uri, ["http://dbpedia.org/ontology/Type%d" % j \
+                    for j in sorted(rng.choice(10, rng.randint(0, 4), replace = False))]) \
+                    for uri in uris)
+    types[uris[0]] = ["http://dbpedia.org/ontology/Many%02d" % j for j in range(25)]
+    return uris, types
+
+def test_get_types_batch_retries_and_splits(monkeypatch):
+    #The endpoint cuts results after 8 rows, so the batches of 10 entities
+    #have to be split and the types of the first entity fetched in pages
+    monkeypatch.setattr(gd, 'MAX_ROWS', 8)
+    uris, types = make_types(300)
+    with MockSPARQLServer(SyntheticBackend(types = types, max_rows = 8), error_rate = 0.2, \
+                                                    random_state = 0) as server:
+        client = SPARQLClient(server.url, retries = 10, backoff = 0.001)
+        skipped = []
+        with pytest.warns(UserWarning, match = "1 entities"):
+            result = gd.get_types_batch(uris + ["http://dbpedia.org/resource/Bad name"], \
+                    batch_size = 10, max_workers = 4, client = client, skipped = skipped)
+        client.close()
+    assert server.errors > 0
+    assert skipped == ["http://dbpedia.org/resource/Bad name"]
+    assert result.pop("http://dbpedia.org/resource/Bad name") == []
+    assert dict((uri, sorted(each)) for uri, each in result.items()) == types
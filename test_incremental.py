@@ -0,0 +1,63 @@
+from collections import Counter
+import numpy as np
+import main
+from incremental import IncrementalDetector
+
+PARAMETERS = dict(upper = 90, lower = 10, iqrFactor = 1.5, madFactor = 2)
+
+
+def recompute(values, uris, clusters):
+    """The (URI, value) pairs flagged by main.py on the whole dataset"""
+    preprocess = clusters is not None
+    return {
+        'IQR' : Counter((uris[i], values[i]) for i in main.find_outliers_using_IQR(values, \
+                    PARAMETERS['upper'], PARAMETERS['lower'], PARAMETERS['iqrFactor'], \
+                    preprocess = preprocess, clusters = clusters)),
+        'MAD' : Counter((uris[i], values[i]) for i in main.find_outliers_using_MAD(values, \
+                    PARAMETERS['madFactor'], preprocess = preprocess, clusters = clusters)),
+    }
+
+def new_version(rng, values, uris, clusters, n):
+    """Deletes about 10% of the rows, changes about 10% of the values and
+    inserts up to 20 rows, some with the URI of an existing row"""
+    keep = rng.rand(values.size) > 0.1
+    values, uris = values[keep].copy(), [each for each, kept in zip(uris, keep) if kept]
+    changed = rng.rand(values.size) < 0.1
+    values[changed] = np.round(rng.standard_t(2, changed.sum())*10)
+    k = rng.randint(0, 20)
+    uris += ["http://x/%d" % each for each in rng.randint(0, 2*n, k)]
+    values = np.concatenate((values, np.round(rng.standard_t(2, k)*10)))
+    if clusters is not None:
+        clusters = np.concatenate((clusters[keep], rng.randint(0, 4, k)))
+    return values, uris, clusters
+
+def test_update_matches_recompute():
+    rng = np.random.RandomState(0)
+    for trial in range(40):
+        n = rng.randint(1, 300)
+        uris = ["http://x/%d" % each for each in rng.randint(0, n, n)]
+        values = np.round(rng.standard_t(2, n)*10)
+        clusters = rng.randint(0, 3, n) if trial % 2 else None
+        detector = IncrementalDetector(values, uris, clusters, **PARAMETERS)
+        current = recompute(values, uris, clusters)
+        for step in range(5):
+            values, uris, clusters = new_version(rng, values, uris, clusters, n)
+            changes = detector.update(values, uris, clusters)
+            expected = recompute(values, uris, clusters)
+            for method in ('IQR', 'MAD'):
+                added, removed = changes[method]
+                assert Counter(added) - Counter(removed) == expected[method] - current[method]
+                assert Counter(removed) - Counter(added) == current[method] - expected[method]
+                outlier_uris, outlier_values = detector.outliers(method)
+                assert Counter(zip(outlier_uris, outlier_values)) == expected[method]
+            current = expected
+
+def test_save_and_load(tmp_path):
+    rng = np.random.RandomState(1)
+    uris = ["http://x/%d" % i for i in range(200)]
+    values = np.round(rng.standard_t(2, 200)*10)
+    detector = IncrementalDetector(values, uris, rng.randint(0, 3, 200), **PARAMETERS)
+    detector.save(str(tmp_path / "state"))
+    loaded = IncrementalDetector.load(str(tmp_path / "state"))
+    for method in ('IQR', 'MAD'):
+        assert Counter(zip(*loaded.outliers(method))) == Counter(zip(*detector.outliers(method)))
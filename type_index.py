@@ -0,0 +1,251 @@
+import json
+import os
+import shutil
+import time
+import numpy as np
+from scipy import sparse
+import get_data as gd
+from columns import StringTable, string_hashes, check_hashes
+import instrumentation
+
+MANIFEST = "manifest.json"
+FORMAT_VERSION = 2
+
+
+def _gather(array, starts, lengths):
+    """Concatenates array[start:start + length] of every range in one vectorized gather"""
+    total = int(lengths.sum())
+    if total == 0:
+        return array[:0]
+    begins = np.cumsum(lengths) - lengths
+    return array[np.repeat(starts - begins, lengths) + np.arange(total)]
+
+
+class TypeIndex(object):
+    """A persistent index of the types (rdf:type) of entities.
+
+        Every type URI is interned once in a vocabulary (a columns.StringTable
+        whose row is the type id), and the type ids of the entities are
+        stored as CSR postings: the types of entity i are
+        type_ids[indptr[i]:indptr[i + 1]], in the order the endpoint returned
+        them. The entities are kept sorted by a 64-bit hash of their URI (see
+        columns.string_hashes), so a lookup is a binary search and a match
+        is checked against the bytes of the URI.
+
+        The index is saved as a directory of .npy files which load memory
+        maps, so one index can be shared by every property and run whose
+        entities overlap. update() fetches the types of the entities which
+        are not in the index yet, and features() builds the feature matrix
+        of clustering.prepare_dataset for any p without a query.
+
+        The arguments are
+        hashes : The sorted hashes of the entity URIs
+        entities : The columns.StringTable of the entity URIs, in the same order
+        indptr, type_ids : The postings of the entities
+        types : The columns.StringTable of the type URIs
+    """
+
+    def __init__(self, hashes = None, entities = None, indptr = None, type_ids = None, types = None):
+        self.hashes = np.zeros(0, dtype = np.uint64) if hashes is None else hashes
+        self.entities = StringTable.from_strings([]) if entities is None else entities
+        self.indptr = np.zeros(1, dtype = np.int64) if indptr is None else indptr
+        self.type_ids = np.zeros(0, dtype = np.int32) if type_ids is None else type_ids
+        self.types = StringTable.from_strings([]) if types is None else types
+        self._type_id = None
+
+    def __len__(self):
+        return self.hashes.size
+
+    @property
+    def n_types(self):
+        return len(self.types)
+
+    def lookup(self, uris):
+        """Returns the row of every URI (list or columns.StringTable) in the
+        index, -1 for the URIs which are not in it"""
+        if not isinstance(uris, StringTable):
+            uris = StringTable.from_strings(uris)
+        rows = np.full(len(uris), -1, dtype = np.int64)
+        if rows.size == 0 or self.hashes.size == 0:
+            return rows
+        hashes = string_hashes(uris)
+        position = np.minimum(np.searchsorted(self.hashes, hashes), self.hashes.size - 1)
+        found = np.flatnonzero(self.hashes[position] == hashes)
+        #A URI with the hash of an entity has to be that entity
+        lengths, known = np.diff(uris.offsets), np.diff(self.entities.offsets)
+        if np.any(lengths[uris.codes[found]] != known[self.entities.codes[position[found]]]) or \
+                uris.lines(found, separator = b"") != \
+                self.entities.lines(position[found], separator = b""):
+            raise ValueError("Two different URIs have the same 64-bit hash")
+        rows[found] = position[found]
+        return rows
+
+    def missing(self, uris):
+        """Returns the distinct URIs which are not in the index, in their first order"""
+        if not isinstance(uris, StringTable):
+            uris = StringTable.from_strings(uris)
+        absent = np.flatnonzero(self.lookup(uris) < 0)
+        seen = set()
+        result = []
+        for each in uris.take(absent):
+            if each not in seen:
+                seen.add(each)
+                result.append(each)
+        return result
+
+    def _intern(self, type_URIs):
+        if self._type_id is None:
+            self._type_id = dict((each, i) for i, each in enumerate(self.types))
+        new = []
+        ids = []
+        for each in type_URIs:
+            i = self._type_id.get(each)
+            if i is None:
+                i = self._type_id[each] = len(self.types) + len(new)
+                new.append(each)
+            ids.append(i)
+        if new:
+            added = StringTable.from_strings(new)
+            self.types = StringTable(np.concatenate((self.types.data[:self.types.offsets[-1]], \
+                        added.data)), np.concatenate((self.types.offsets, \
+                        self.types.offsets[-1] + added.offsets[1:])))
+        return ids
+
+    def add(self, entity_types):
+        """This function adds entities to the index.
+
+            The argument is a dictionary with the list of types of every entity
+            (as returned by get_data.get_types_batch). Entities which are
+            already in the index keep their types. The new entities are merged
+            into the sorted order with one sort, the postings are reordered
+            with one gather.
+
+            It returns the number of entities added.
+        """
+        uris = self.missing(list(entity_types))
+        if not uris:
+            return 0
+        lengths = np.fromiter((len(entity_types[each]) for each in uris), \
+                                            dtype = np.int64, count = len(uris))
+        new_ids = np.array(self._intern(each for uri in uris for each in entity_types[uri]), \
+                                                                    dtype = np.int32)
+        added = StringTable.from_strings(uris)
+        new_hashes = string_hashes(added)
+        check_hashes(added, new_hashes)
+        hashes = np.concatenate((self.hashes, new_hashes))
+        order = np.argsort(hashes, kind = 'stable')
+        starts = np.concatenate((self.indptr[:-1], self.indptr[-1] + np.cumsum(lengths) - lengths))
+        counts = np.concatenate((np.diff(self.indptr), lengths))
+        type_ids = np.concatenate((self.type_ids, new_ids))
+        self.type_ids = _gather(type_ids, starts[order], counts[order])
+        self.indptr = np.concatenate(([0], np.cumsum(counts[order])))
+        self.hashes = hashes[order]
+        self.entities = self.entities.concatenate(added).take(order)
+        return len(uris)
+
+    def update(self, uris, batch_size = 50, max_workers = 4, fetch = None):
+        """This function fetches the types of the entities which are not in the
+        index yet (with get_data.get_types_batch, or fetch) and adds them.
+        It returns the number of entities which were fetched."""
+        uris = self.missing(uris)
+        if not uris:
+            return 0
+        instrumentation.count('entities_typed', len(uris))
+        with instrumentation.span('type_lookup'):
+            if fetch is None:
+                entity_types = gd.get_types_batch(uris, batch_size = batch_size, \
+                                                    max_workers = max_workers)
+            else:
+                entity_types = fetch(uris)
+        for each in uris:
+            entity_types.setdefault(each, [])
+        return self.add(entity_types)
+
+    def _postings(self, uris):
+        rows = self.lookup(uris)
+        if (rows < 0).any():
+            raise KeyError("%d entities are not in the type index, call update() first" % \
+                                                                    (rows < 0).sum())
+        lengths = self.indptr[rows + 1] - self.indptr[rows]
+        return rows, lengths, _gather(self.type_ids, self.indptr[rows], lengths)
+
+    def type_counts(self, uris):
+        """Returns the number of rows of uris which have each type id"""
+        _, _, postings = self._postings(uris)
+        return np.bincount(postings, minlength = self.n_types)
+
+    def features(self, uris, p = 0.05, return_types = False):
+        """This function builds the type feature matrix of the entities from the
+        index, without querying the endpoint.
+
+            It is the matrix of clustering.prepare_dataset: the types are
+            counted over the rows of uris, the ones discarded by
+            clustering.discard_p for this p are left out and the other types
+            get their columns in the order they first occur.
+
+            It returns a scipy CSR matrix of uint8 with one row per URI, and
+            with return_types the type URIs of the columns as well.
+        """
+        rows, lengths, postings = self._postings(uris)
+        counts = np.bincount(postings, minlength = self.n_types)
+        total = np.count_nonzero(counts)
+        share = counts/float(max(total, 1))
+        kept = (counts > 0) & (share < 1 - p) & (share > p)
+        present, first = np.unique(postings, return_index = True)
+        columns = present[kept[present]][np.argsort(first[kept[present]], kind = 'stable')]
+        column_of = np.full(self.n_types, -1, dtype = np.int64)
+        column_of[columns] = np.arange(columns.size)
+
+        column = column_of[postings]
+        row = np.repeat(np.arange(rows.size), lengths)
+        keep = column >= 0
+        X = sparse.csr_matrix((np.ones(keep.sum(), dtype = np.uint8), (row[keep], column[keep])), \
+                                                    shape = (rows.size, columns.size))
+        if return_types:
+            return X, [self.types[i] for i in columns]
+        return X
+
+    def save(self, path):
+        """Saves the index as a directory of .npy files and a manifest, written
+        next to path and renamed into place like snapshot.save_snapshot"""
+        arrays = {
+            'hashes' : self.hashes,
+            'entity_data' : self.entities.data[:self.entities.offsets[-1]],
+            'entity_offsets' : self.entities.offsets,
+            'entity_codes' : self.entities.codes,
+            'indptr' : self.indptr,
+            'type_ids' : self.type_ids,
+            'type_data' : self.types.data[:self.types.offsets[-1]],
+            'type_offsets' : self.types.offsets,
+        }
+        manifest = {
+            'version' : FORMAT_VERSION,
+            'created' : time.time(),
+            'entities' : int(self.hashes.size),
+            'types' : int(self.n_types),
+            'arrays' : sorted(arrays),
+        }
+        temporary = path.rstrip(os.sep) + ".tmp"
+        if os.path.exists(temporary):
+            shutil.rmtree(temporary)
+        os.makedirs(temporary)
+        for name, array in arrays.items():
+            np.save(os.path.join(temporary, name + ".npy"), np.ascontiguousarray(array))
+        with open(os.path.join(temporary, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent = 1)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(temporary, path)
+
+    @classmethod
+    def load(cls, path, mmap_mode = 'r'):
+        """Opens an index saved by save(), memory mapped by default. An index
+        which does not exist yet is returned empty, so the first run creates it."""
+        if not os.path.exists(os.path.join(path, MANIFEST)):
+            return cls()
+        arrays = dict((name, np.load(os.path.join(path, name + ".npy"), mmap_mode = mmap_mode)) \
+                            for name in ('hashes', 'entity_data', 'entity_offsets', 'entity_codes', \
+                                        'indptr', 'type_ids', 'type_data', 'type_offsets'))
+        return cls(arrays['hashes'], StringTable(arrays['entity_data'], arrays['entity_offsets'], \
+                            arrays['entity_codes']), arrays['indptr'], arrays['type_ids'], \
+                            StringTable(arrays['type_data'], arrays['type_offsets']))